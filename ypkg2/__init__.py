@@ -13,7 +13,11 @@
 
 from .ui import YpkgUI
 
+import hashlib
+import json
+import os
 import re
+import tempfile
 
 
 global console_ui
@@ -28,6 +32,37 @@ def remove_prefix(fpath, prefix):
         fpath = "/" + fpath
     return fpath
 
+# Files are hashed in chunks of this size, never read whole into memory
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path, algo="sha256"):
+    """ Return the hex digest of the file at path using the named hashlib
+        algorithm """
+    h = hashlib.new(algo)
+    with open(path, "rb") as inp:
+        while True:
+            chunk = inp.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def atomic_write_json(path, data):
+    """ Write data to path as JSON via a temporary file in the same
+        directory, so that readers never see it partially written """
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".ypkg-")
+        with os.fdopen(fd, "w") as out:
+            json.dump(data, out)
+        os.rename(tmp, path)
+        tmp = None
+    finally:
+        if tmp:
+            os.unlink(tmp)
+
 pkgconfig32_dep = re.compile("^pkgconfig32\((.*)\)$")
 pkgconfig_dep = re.compile("^pkgconfig\((.*)\)$")
 
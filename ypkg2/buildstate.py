@@ -0,0 +1,101 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+from . import console_ui, atomic_write_json
+
+import os
+import json
+import hashlib
+
+STATE_NAME = ".ypkg-build-state.json"
+
+# Bump whenever the archive layout changes, so older state is not trusted
+STATE_VERSION = 1
+
+
+def get_package_digest(pdir, timestamp, identity):
+    """ Digest everything that determines the content of an eopkg: the
+        staged metadata.xml and files.xml, which between them cover the
+        file list, content hashes, metadata fields and dependencies, along
+        with the history timestamp and how the payload is compressed. """
+    h = hashlib.sha1()
+    h.update("{}\0{}\0{}\0".format(STATE_VERSION, timestamp, identity))
+    for name in ["metadata.xml", "files.xml"]:
+        with open(os.path.join(pdir, name), "rb") as inp:
+            h.update(inp.read())
+        h.update("\0")
+    return h.hexdigest()
+
+
+class BuildState:
+    """ Record of the eopkgs written by the previous build into an output
+        directory, keyed by file name, so that unchanged packages can be
+        reused rather than recompressed. Only the packages of the current
+        build are kept when it is saved. """
+
+    path = None
+    entries = None
+    current = None
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, STATE_NAME)
+        self.entries = dict()
+        self.current = dict()
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as inp:
+                data = json.load(inp)
+        except Exception as e:
+            console_ui.emit_warning("Package", "Ignoring corrupt build "
+                                    "state: {}".format(e))
+            return
+        if data.get("version") != STATE_VERSION:
+            return
+        self.entries = data.get("packages", dict())
+
+    def _stat(self, fpath):
+        try:
+            st = os.stat(fpath)
+        except Exception:
+            return None
+        return [st.st_size, int(st.st_mtime)]
+
+    def has_package(self, fpath):
+        """ Whether fpath was written by the last build and is untouched """
+        entry = self.entries.get(os.path.basename(fpath))
+        if not entry:
+            return False
+        return entry["stat"] == self._stat(fpath)
+
+    def is_current(self, fpath, digest):
+        """ Whether fpath can be reused for a package with this digest """
+        if not self.has_package(fpath):
+            return False
+        return self.entries[os.path.basename(fpath)]["digest"] == digest
+
+    def record(self, fpath, digest):
+        """ Note the package as produced by this build """
+        self.current[os.path.basename(fpath)] = {
+            "digest": digest,
+            "stat": self._stat(fpath),
+        }
+
+    def save(self):
+        """ Replace the stored state with that of this build """
+        data = {"version": STATE_VERSION, "packages": self.current}
+        try:
+            atomic_write_json(self.path, data)
+        except Exception as e:
+            console_ui.emit_warning("Package", "Failed to save build state: "
+                                    "{}".format(e))
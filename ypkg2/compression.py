@@ -0,0 +1,329 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+from distutils.spawn import find_executable
+import grp
+import hashlib
+import os
+import pwd
+import re
+import stat
+import subprocess
+import tarfile
+import time
+
+PAYLOAD_NAME = "install.tar.xz"
+
+# Used when neither the command line nor the build config sets a level
+DEFAULT_LEVEL = 6
+FAST_LEVEL = 0
+
+KiB = 1024
+MiB = 1024 * 1024
+
+# LZMA2 dictionary size used by each xz preset
+XzDictSizes = {
+    0: 256 * KiB,
+    1: 1 * MiB,
+    2: 2 * MiB,
+    3: 4 * MiB,
+    4: 4 * MiB,
+    5: 8 * MiB,
+    6: 8 * MiB,
+    7: 16 * MiB,
+    8: 32 * MiB,
+    9: 64 * MiB,
+}
+
+size_spec = re.compile(r"^(\d+)\s*(k|kib|m|mib)?$", re.IGNORECASE)
+
+
+class CompressionError(Exception):
+    pass
+
+
+def parse_size(value):
+    """ Parse a size such as 64MiB, 512k or a plain byte count """
+    m = size_spec.match(value.strip())
+    if not m:
+        raise CompressionError("Invalid size: {}".format(value))
+    size = int(m.group(1))
+    unit = (m.group(2) or "").lower()
+    if unit.startswith("k"):
+        size *= KiB
+    elif unit.startswith("m"):
+        size *= MiB
+    return size
+
+
+class CompressionStats:
+    """ Record of a single payload compression """
+
+    def __init__(self, input_size, output_size, duration):
+        self.input_size = input_size
+        self.output_size = output_size
+        self.duration = duration
+
+    def get_ratio(self):
+        """ Compressed size as a percentage of the input """
+        if self.input_size == 0:
+            return 100.0
+        return 100.0 * self.output_size / self.input_size
+
+
+def get_tarinfo(tar, arcname, st, target, names):
+    """ Build the TarInfo that tar.gettarinfo would for a path, from the
+        lstat result and link target the install manifest already holds
+        rather than another lstat. names caches user and group lookups.
+        Returns None for types tarfile can't archive, such as sockets. """
+    arcname = arcname.replace(os.sep, "/").lstrip("/")
+    info = tar.tarinfo()
+    info.tarfile = tar
+
+    linkname = ""
+    mode = st.st_mode
+    if stat.S_ISREG(mode):
+        inode = (st.st_ino, st.st_dev)
+        if not tar.dereference and st.st_nlink > 1 and \
+                inode in tar.inodes and arcname != tar.inodes[inode]:
+            ftype = tarfile.LNKTYPE
+            linkname = tar.inodes[inode]
+        else:
+            ftype = tarfile.REGTYPE
+            if inode[0]:
+                tar.inodes[inode] = arcname
+    elif stat.S_ISDIR(mode):
+        ftype = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(mode):
+        ftype = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(mode):
+        ftype = tarfile.SYMTYPE
+        linkname = target
+    elif stat.S_ISCHR(mode):
+        ftype = tarfile.CHRTYPE
+    elif stat.S_ISBLK(mode):
+        ftype = tarfile.BLKTYPE
+    else:
+        return None
+
+    info.name = arcname
+    info.mode = mode
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.size = st.st_size if ftype == tarfile.REGTYPE else 0L
+    info.mtime = st.st_mtime
+    info.type = ftype
+    info.linkname = linkname
+
+    if ("u", info.uid) not in names:
+        try:
+            names[("u", info.uid)] = pwd.getpwuid(info.uid)[0]
+        except KeyError:
+            names[("u", info.uid)] = None
+    if ("g", info.gid) not in names:
+        try:
+            names[("g", info.gid)] = grp.getgrgid(info.gid)[0]
+        except KeyError:
+            names[("g", info.gid)] = None
+    if names[("u", info.uid)] is not None:
+        info.uname = names[("u", info.uid)]
+    if names[("g", info.gid)] is not None:
+        info.gname = names[("g", info.gid)]
+
+    if ftype in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        info.devmajor = os.major(st.st_rdev)
+        info.devminor = os.minor(st.st_rdev)
+    return info
+
+
+class HashingReader:
+    """ Wrap a file object so that everything read is also digested """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+
+class PayloadCompressor:
+    """ Writes the install.tar.xz payload of an eopkg. It is handed the open
+        pisi Package, after metadata and files have been added, and adds
+        the payload and closes the package. This base backend leaves the
+        payload to pisi itself, as ypkg always used to.
+
+        Backends with hashes_members set can instead produce the payload
+        up front with create_payload, hashing each file as it is archived,
+        so that files.xml can be completed without reading files twice. """
+
+    name = "pisi"
+    threads = 1
+    hashes_members = False
+
+    def configure(self, context):
+        """ Take any settings not given on the command line from the build
+            configuration """
+        pass
+
+    def get_identity(self):
+        """ Describe the settings that affect the payload produced """
+        return self.name
+
+    def write_payload(self, pkg, pdir, members, timestamp):
+        """ Add members, a list of (path, arcname, lstat), as the payload of
+            pkg and close it. lstat is the (stat result, link target) held
+            by the install manifest, or None. Returns CompressionStats, or
+            None if the backend cannot measure them. """
+        for path, arcname, lstat in members:
+            pkg.add_to_install(path, arcname)
+        pfile = os.path.join(pdir, PAYLOAD_NAME)
+        os.utime(pfile, (timestamp, timestamp))
+        pkg.close()
+        return None
+
+
+class XzCompressor(PayloadCompressor):
+    """ Stream the payload tarball through xz. The block size is always
+        fixed by the dictionary size, so the output is identical however
+        many threads are used, and the multi-block stream that results is
+        still a normal .xz file. """
+
+    name = "xz"
+    hashes_members = True
+    level = None
+    dict_size = None
+
+    def __init__(self, level=None, dict_size=None):
+        if level is not None and level not in XzDictSizes:
+            raise CompressionError("Invalid xz level: {}".format(level))
+        self.level = level
+        self.dict_size = dict_size
+
+    def configure(self, context):
+        """ Default to the compressionlevel pisi itself would have used """
+        if self.level is not None:
+            return
+        value = getattr(context.pconfig.values.build, "compressionlevel",
+                        None)
+        if value is None or str(value).strip() == "":
+            self.level = DEFAULT_LEVEL
+            return
+        try:
+            level = int(value)
+        except ValueError:
+            level = None
+        if level not in XzDictSizes:
+            raise CompressionError("Invalid compressionlevel in config: {}".
+                                   format(value))
+        self.level = level
+
+    def get_dict_size(self):
+        if self.dict_size:
+            return self.dict_size
+        return XzDictSizes[self.level]
+
+    def get_identity(self):
+        return "{}-{}-{}".format(self.name, self.level, self.get_dict_size())
+
+    def get_command(self):
+        dict_size = self.get_dict_size()
+        # A single thread selects the single-threaded encoder, which writes
+        # different block headers, so always stay in threaded mode.
+        threads = max(2, self.threads)
+        return ["xz", "--compress", "--stdout", "--quiet",
+                "--threads={}".format(threads),
+                "--block-size={}".format(3 * dict_size),
+                "--lzma2=preset={},dict={}".format(self.level, dict_size)]
+
+    def add_member(self, tar, path, arcname, lstat, digests, names):
+        """ Add a path to the tarball as tar.add would, returning its SHA1 as
+            eopkg records it, computed from the data as it is archived """
+        if lstat is None:
+            info = tar.gettarinfo(path, arcname)
+        else:
+            info = get_tarinfo(tar, arcname, lstat[0], lstat[1], names)
+        digest = None
+        if info is None:
+            # tar.add skips what it cannot archive, and so do we
+            return None
+        if info.isreg():
+            with open(path, "rb") as inp:
+                reader = HashingReader(inp)
+                tar.addfile(info, reader)
+            digest = reader.digest.hexdigest()
+        elif info.isdir() and lstat is None:
+            tar.add(path, arcname)
+        else:
+            tar.addfile(info)
+            if info.issym():
+                target = os.path.normpath(info.linkname)
+                digest = hashlib.sha1(target).hexdigest()
+            elif info.islnk():
+                # Hard links carry no data, it is the same as the original
+                digest = digests.get(info.linkname)
+        digests[info.name] = digest
+        return digest
+
+    def create_payload(self, pdir, members, timestamp):
+        """ Write the payload for members, as for write_payload, returning
+            its path, the CompressionStats and the SHA1 of each member in
+            the same order """
+        pfile = os.path.join(pdir, PAYLOAD_NAME)
+        start = time.time()
+        hashes = list()
+        digests = dict()
+        names = dict()
+        with open(pfile, "wb") as out:
+            proc = subprocess.Popen(self.get_command(), stdin=subprocess.PIPE,
+                                    stdout=out)
+            try:
+                tar = tarfile.open(fileobj=proc.stdin, mode="w|")
+                for path, arcname, lstat in members:
+                    hashes.append(self.add_member(tar, path, arcname, lstat,
+                                                  digests, names))
+                tar.close()
+                input_size = tar.offset
+            finally:
+                proc.stdin.close()
+                ret = proc.wait()
+        if ret != 0:
+            raise CompressionError("xz exited with status {}".format(ret))
+        stats = CompressionStats(input_size, os.path.getsize(pfile),
+                                 time.time() - start)
+        os.utime(pfile, (timestamp, timestamp))
+        return pfile, stats, hashes
+
+    def write_payload(self, pkg, pdir, members, timestamp):
+        pfile, stats, hashes = self.create_payload(pdir, members, timestamp)
+        pkg.add_to_package(pfile, PAYLOAD_NAME)
+        pkg.close()
+        os.unlink(pfile)
+        return stats
+
+
+def get_compressor(name, level=None, dict_size=None, fast=False):
+    """ Construct the named compression backend """
+    if name == PayloadCompressor.name:
+        return PayloadCompressor()
+    if name != XzCompressor.name:
+        raise CompressionError("Unknown compressor: {}".format(name))
+    if not find_executable("xz"):
+        raise CompressionError("xz is not installed")
+    if fast:
+        level = FAST_LEVEL
+    if dict_size is not None:
+        dict_size = parse_size(dict_size)
+    return XzCompressor(level=level, dict_size=dict_size)
@@ -11,10 +11,13 @@
 #  (at your option) any later version.
 #
 
-from . import console_ui
+from . import console_ui, atomic_write_json
 from pisi.db.installdb import InstallDB
 from pisi.db.packagedb import PackageDB
 from pisi.db.filesdb import FilesDB
+from .installindex import InstallIndex, get_installed_versions
+import hashlib
+import json
 import os
 
 # Provided historically for our pre-glvnd architecture.
@@ -45,31 +48,56 @@ class DependencyResolver:
     pdb = None
     fdb = None
 
-    global_rpaths = set()
-    global_rpaths32 = set()
-    global_sonames = dict()
-    global_sonames32 = dict()
-    global_pkgconfigs = dict()
-    global_pkgconfig32s = dict()
-    global_kernels = dict()
+    # Persistent path/soname/pkgconfig index of the installed system,
+    # opened on the first lookup that needs it
+    index = None
+    index_opened = False
+
+    global_rpaths = None
+    global_rpaths32 = None
+    global_sonames = None
+    global_sonames32 = None
+    global_pkgconfigs = None
+    global_pkgconfig32s = None
+    global_kernels = None
     gene = None
 
-    bindeps_cache = dict()
-    bindeps_emul32 = dict()
+    bindeps_cache = None
+    bindeps_emul32 = None
 
-    pkgconfig_cache = dict()
-    pkgconfig32_cache = dict()
+    pkgconfig_cache = None
+    pkgconfig32_cache = None
 
-    files_cache = dict()
+    files_cache = None
 
-    kernel_cache = dict()
+    kernel_cache = None
 
-    deadends = dict()
+    deadends = None
 
     # Cached from packagedb
     pkgConfigs = None
     pkgConfigs32 = None
 
+    # Whether our lookup caches are kept between builds
+    persistent = True
+
+    # Identifies the installed package set the caches are valid for
+    generation = None
+
+    # (cache name, key) pairs that must not outlive this build
+    volatile = None
+
+    # Lookup caches persisted between builds. The global_* maps describe
+    # the package being built and are never persisted.
+    persistent_caches = [
+        "bindeps_cache",
+        "bindeps_emul32",
+        "pkgconfig_cache",
+        "pkgconfig32_cache",
+        "kernel_cache",
+        "deadends",
+    ]
+
     def search_file(self, fname):
         if fname[0] == '/':
             fname = fname[1:]
@@ -86,8 +114,23 @@ class DependencyResolver:
         self.deadends[fname] = 0
         return None
 
-    def __init__(self):
+    def __init__(self, persistent=True):
         """ Allows us to do look ups on all packages """
+        self.persistent = persistent
+
+        self.global_rpaths = set()
+        self.global_rpaths32 = set()
+        self.global_sonames = dict()
+        self.global_sonames32 = dict()
+        self.global_pkgconfigs = dict()
+        self.global_pkgconfig32s = dict()
+        self.global_kernels = dict()
+
+        self.files_cache = dict()
+        for cache in self.persistent_caches:
+            setattr(self, cache, dict())
+        self.volatile = set()
+
         self.idb = InstallDB()
         self.pdb = PackageDB()
         self.fdb = FilesDB()
@@ -95,6 +138,76 @@ class DependencyResolver:
         # Cache the pkgconfigs known in the pdb
         self.pkgConfigs, self.pkgConfigs32 = self.pdb.get_pkgconfig_providers()
 
+    def get_index(self):
+        """ Return the installed system index, opening it on first use """
+        if not self.index_opened:
+            self.index_opened = True
+            self.open_index(self.ctx)
+        return self.index
+
+    def open_index(self, context):
+        """ Open and refresh the installed system index. Failure here is
+            not fatal, we simply fall back to querying the FilesDB. """
+        ipath = os.path.join(context.get_cache_dir(), "resolver", "index.db")
+        try:
+            self.index = InstallIndex(ipath)
+            self.index.update(self.idb)
+        except Exception as e:
+            console_ui.emit_warning("Index", "Cannot use installed files "
+                                    "index: {}".format(e))
+            if self.index:
+                self.index.close()
+            self.index = None
+
+    def get_cache_path(self, context):
+        return os.path.join(context.get_cache_dir(), "resolver",
+                            "caches.json")
+
+    def get_generation(self):
+        """ Hash of the installed name/version-release pairs. Any change to
+            the installed system invalidates our persisted caches. """
+        h = hashlib.sha1()
+        for name, version in sorted(get_installed_versions(self.idb).items()):
+            h.update("{}={}\n".format(name, version))
+        return h.hexdigest()
+
+    def load_caches(self, context):
+        """ Restore lookup caches from a previous build, if still valid """
+        self.generation = self.get_generation()
+        cpath = self.get_cache_path(context)
+        if not os.path.exists(cpath):
+            return
+        try:
+            with open(cpath, "r") as inp:
+                data = json.load(inp)
+        except Exception as e:
+            console_ui.emit_warning("Dependency", "Ignoring corrupt resolver "
+                                    "cache: {}".format(e))
+            return
+        if data.get("generation") != self.generation:
+            return
+        for cache in self.persistent_caches:
+            stored = data.get(cache, dict())
+            getattr(self, cache).update((str(k), str(v))
+                                        for k, v in stored.items())
+
+    def save_caches(self, context):
+        """ Persist the lookup caches for the next build """
+        data = dict()
+        data["generation"] = self.generation
+        for cache in self.persistent_caches:
+            data[cache] = dict((k, v) for k, v in getattr(self, cache).items()
+                               if (cache, k) not in self.volatile)
+
+        cpath = self.get_cache_path(context)
+        try:
+            if not os.path.exists(os.path.dirname(cpath)):
+                os.makedirs(os.path.dirname(cpath), mode=00755)
+            atomic_write_json(cpath, data)
+        except Exception as e:
+            console_ui.emit_warning("Dependency", "Failed to save resolver "
+                                    "cache: {}".format(e))
+
     def get_symbol_provider(self, info, symbol):
         """ Grab the symbol from the local packages """
         if info.emul32:
@@ -134,43 +247,63 @@ class DependencyResolver:
             else:
                 return "libglvnd"
 
+        defaults = list()
         if not paths:
             paths = ["/usr/lib64", "/usr/lib"]
             if info.emul32:
                 paths = ["/usr/lib32", "/usr/lib", "/usr/lib64"]
+            defaults = list(paths)
 
             if info.rpaths:
                 paths.extend(info.rpaths)
 
+        # One query answers for every library directory, rpaths aside
+        index = self.get_index()
+        owners = index.get_soname_owners(symbol) if index else dict()
+
         pkg = None
         for path in paths:
             fpath = os.path.join(path, symbol)
-            if not os.path.exists(fpath):
-                continue
-            lpkg = None
-            if fpath in self.files_cache:
-                lpkg = self.files_cache[fpath]
-            else:
-                pkg = self.search_file(fpath)
-                if pkg:
-                    lpkg = pkg[0]
+            lpkg = owners.get(path)
+            if not lpkg:
+                lpkg = self.get_installed_owner(fpath)
             if lpkg:
-                if info.emul32:
-                    self.bindeps_emul32[symbol] = lpkg
-                else:
-                    self.bindeps_cache[symbol] = lpkg
+                cache = "bindeps_emul32" if info.emul32 else "bindeps_cache"
+                getattr(self, cache)[symbol] = lpkg
+                # Only valid for this package's rpaths
+                if path not in defaults:
+                    self.volatile.add((cache, symbol))
                 console_ui.emit_info("Dependency",
                                      "{} adds dependency on {} from {}".
                                      format(info.pretty, symbol, lpkg))
-
-                # Populate a global files cache, basically there is a high
-                # chance that each package depends on multiple things in a
-                # single package.
-                for file in self.idb.get_files(lpkg).list:
-                    self.files_cache["/" + file.path] = lpkg
                 return lpkg
         return None
 
+    def get_installed_owner(self, fpath):
+        """ Find the installed package owning fpath, via the index when we
+            have one, and the FilesDB otherwise """
+        index = self.get_index()
+        if index:
+            lpkg = index.get_file_owner(fpath)
+            if lpkg:
+                return lpkg
+        if not os.path.exists(fpath):
+            return None
+        if fpath in self.files_cache:
+            return self.files_cache[fpath]
+        pkg = self.search_file(fpath)
+        if not pkg:
+            return None
+        lpkg = pkg[0]
+
+        # Without the index, populate a global files cache, as there is a
+        # high chance that each package depends on multiple things in a
+        # single package.
+        if not index:
+            for file in self.idb.get_files(lpkg).list:
+                self.files_cache["/" + file.path] = lpkg
+        return lpkg
+
     def get_pkgconfig_provider(self, info, name):
         """ Get the internal provider for a pkgconfig name """
         if info.emul32:
@@ -193,6 +326,19 @@ class DependencyResolver:
             if name in self.pkgconfig_cache:
                 return self.pkgconfig_cache[name]
 
+        # Installed providers, in the same order as the FilesDB lookups below
+        index = self.get_index()
+        if index:
+            nom = index.get_pkgconfig_provider(name, info.emul32)
+            if not nom and info.emul32:
+                nom = index.get_pkgconfig_provider(name)
+            if nom:
+                if info.emul32:
+                    self.pkgconfig32_cache[name] = nom
+                else:
+                    self.pkgconfig_cache[name] = nom
+                return nom
+
         if info.emul32:
             # InstallDB set
             nom = self.fdb.get_pkgconfig32_provider(name)
@@ -220,10 +366,11 @@ class DependencyResolver:
 
         if not pkg:
             return None
-        if info.emul32:
-            self.pkgconfig32_cache[name] = pkg.name
-        else:
-            self.pkgconfig_cache[name] = pkg.name
+        cache = "pkgconfig32_cache" if info.emul32 else "pkgconfig_cache"
+        getattr(self, cache)[name] = pkg.name
+        # Repository providers change independently of the installed set
+        if not self.idb.has_package(pkg.name):
+            self.volatile.add((cache, name))
         return pkg.name
 
     def handle_binary_deps(self, packageName, info):
@@ -319,26 +466,12 @@ class DependencyResolver:
         for path in paths:
             # Special file in the main kernel package
             fpath = "{}/System.map-{}".format(path, version)
-            if not os.path.exists(fpath):
-                continue
-            lpkg = None
-            if fpath in self.files_cache:
-                lpkg = self.files_cache[fpath]
-            else:
-                pkg = self.search_file(fpath)
-                if pkg:
-                    lpkg = pkg[0]
+            lpkg = self.get_installed_owner(fpath)
             if lpkg:
                 self.kernel_cache[version] = lpkg
                 console_ui.emit_info("Kernel",
                                      "{} adds module dependency on {} from {}".
                                      format(info.pretty, version, lpkg))
-
-                # Populate a global files cache, basically there is a high
-                # chance that each package depends on multiple things in a
-                # single package.
-                for file in self.idb.get_files(lpkg).list:
-                    self.files_cache["/" + file.path] = lpkg
                 return lpkg
         return None
 
@@ -363,6 +496,9 @@ class DependencyResolver:
         self.packageSet = packageSet
         self.ctx = context
 
+        if self.persistent:
+            self.load_caches(context)
+
         # First iteration, collect the globals
         for packageName in packageSet:
             for info in packageSet[packageName]:
@@ -402,4 +538,7 @@ class DependencyResolver:
 
                 if info.dep_kernel:
                     self.handle_kernel_deps(packageName, info)
+
+        if self.persistent:
+            self.save_caches(context)
         return True
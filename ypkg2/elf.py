@@ -0,0 +1,324 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+import struct
+
+ELF_MAGIC = "\x7fELF"
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+# e_type
+ET_REL = 1
+ET_EXEC = 2
+ET_DYN = 3
+
+# sh_type
+SHT_STRTAB = 3
+SHT_DYNAMIC = 6
+SHT_NOTE = 7
+SHT_NOBITS = 8
+
+# p_type
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_NOTE = 4
+
+# n_type
+NT_GNU_BUILD_ID = 3
+
+# d_tag
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+
+
+ElfTypes = {
+    ET_REL: "relocatable",
+    ET_EXEC: "executable",
+    ET_DYN: "shared object",
+}
+
+
+class ElfError(Exception):
+    pass
+
+
+def describe_elf_header(head):
+    """ Produce a libmagic style description of an ELF object from its
+        leading bytes, i.e. "ELF 64-bit LSB shared object,". Returns None
+        if the header is not one we know how to describe. """
+    if len(head) < 18 or head[0:4] != ELF_MAGIC:
+        return None
+    bits = {ELFCLASS32: "32", ELFCLASS64: "64"}.get(ord(head[4]))
+    if ord(head[5]) == ELFDATA2LSB:
+        order = "LSB"
+        e_type = ord(head[16]) | (ord(head[17]) << 8)
+    elif ord(head[5]) == ELFDATA2MSB:
+        order = "MSB"
+        e_type = (ord(head[16]) << 8) | ord(head[17])
+    else:
+        return None
+    if bits is None or e_type not in ElfTypes:
+        return None
+    return "ELF {}-bit {} {},".format(bits, order, ElfTypes[e_type])
+
+
+class ElfFile:
+    """ Minimal in-process ELF reader, able to walk the headers of both
+        32-bit and 64-bit objects of either byte order without forking
+        out to binutils. Only the pieces ypkg cares about are parsed. """
+
+    path = None
+    elf_class = None
+    elf_type = None
+
+    # Populated by read_dynamic()
+    needed = None
+    rpaths = None
+    soname = None
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = open(path, "rb")
+        try:
+            self._read_header()
+        except Exception:
+            self.fd.close()
+            raise
+
+    def close(self):
+        """ Release the underlying file handle """
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def is_64bit(self):
+        return self.elf_class == ELFCLASS64
+
+    def _read(self, offset, size):
+        self.fd.seek(offset)
+        data = self.fd.read(size)
+        if len(data) != size:
+            raise ElfError("Truncated ELF file: {}".format(self.path))
+        return data
+
+    def _unpack(self, fmt, offset):
+        fmt = self.endian + fmt
+        return struct.unpack(fmt, self._read(offset, struct.calcsize(fmt)))
+
+    def _read_header(self):
+        ident = self.fd.read(16)
+        if len(ident) != 16 or ident[0:4] != ELF_MAGIC:
+            raise ElfError("Not an ELF file: {}".format(self.path))
+        self.elf_class = ord(ident[4])
+        data = ord(ident[5])
+        if data == ELFDATA2LSB:
+            self.endian = "<"
+        elif data == ELFDATA2MSB:
+            self.endian = ">"
+        else:
+            raise ElfError("Unknown ELF byte order: {}".format(self.path))
+
+        if self.elf_class == ELFCLASS64:
+            hdr = self._unpack("HHIQQQIHHHHHH", 16)
+            self.fmt_shdr = "IIQQQQIIQQ"
+            self.fmt_phdr = "IIQQQQQQ"
+            self.fmt_dyn = "qQ"
+        elif self.elf_class == ELFCLASS32:
+            hdr = self._unpack("HHIIIIIHHHHHH", 16)
+            self.fmt_shdr = "IIIIIIIIII"
+            self.fmt_phdr = "IIIIIIII"
+            self.fmt_dyn = "iI"
+        else:
+            raise ElfError("Unknown ELF class: {}".format(self.path))
+
+        self.elf_type = hdr[0]
+        self.phoff = hdr[4]
+        self.shoff = hdr[5]
+        self.phentsize = hdr[8]
+        self.phnum = hdr[9]
+        self.shentsize = hdr[10]
+        self.shnum = hdr[11]
+        self.shstrndx = hdr[12]
+
+    def sections(self):
+        """ Return all section headers as tuples of
+            (name offset, type, addr, offset, size, link) """
+        ret = list()
+        if self.shoff == 0:
+            return ret
+        for i in range(0, self.shnum):
+            s = self._unpack(self.fmt_shdr, self.shoff + i * self.shentsize)
+            ret.append((s[0], s[1], s[3], s[4], s[5], s[6]))
+        return ret
+
+    def segments(self):
+        """ Return all program headers as tuples of
+            (type, offset, vaddr, filesz) """
+        ret = list()
+        if self.phoff == 0:
+            return ret
+        for i in range(0, self.phnum):
+            p = self._unpack(self.fmt_phdr, self.phoff + i * self.phentsize)
+            if self.elf_class == ELFCLASS64:
+                ret.append((p[0], p[2], p[3], p[5]))
+            else:
+                ret.append((p[0], p[1], p[2], p[4]))
+        return ret
+
+    def _vaddr_to_offset(self, segments, vaddr):
+        """ Map a virtual address into a file offset using PT_LOAD """
+        for p_type, p_offset, p_vaddr, p_filesz in segments:
+            if p_type != PT_LOAD:
+                continue
+            if p_vaddr <= vaddr < p_vaddr + p_filesz:
+                return vaddr - p_vaddr + p_offset
+        return None
+
+    def _get_string(self, table, index):
+        end = table.find("\0", index)
+        if end < 0:
+            return table[index:]
+        return table[index:end]
+
+    def _read_dynamic_entries(self, offset, size):
+        entsize = struct.calcsize(self.endian + self.fmt_dyn)
+        blob = self._read(offset, size)
+        ret = list()
+        for i in range(0, size // entsize):
+            tag, val = struct.unpack_from(self.endian + self.fmt_dyn, blob,
+                                          i * entsize)
+            if tag == DT_NULL:
+                break
+            ret.append((tag, val))
+        return ret
+
+    def read_dynamic(self):
+        """ Read the NEEDED, RPATH and SONAME entries from the dynamic
+            section. Returns False if the object has no dynamic section. """
+        entries = None
+        strtab = None
+
+        # Prefer section headers, they directly link the string table
+        sections = self.sections()
+        for sect in sections:
+            if sect[1] != SHT_DYNAMIC:
+                continue
+            entries = self._read_dynamic_entries(sect[3], sect[4])
+            if sect[5] < len(sections):
+                link = sections[sect[5]]
+                strtab = self._read(link[3], link[4])
+            break
+
+        # Fallback to program headers for section-stripped objects
+        if entries is None:
+            segments = self.segments()
+            for seg in segments:
+                if seg[0] != PT_DYNAMIC:
+                    continue
+                entries = self._read_dynamic_entries(seg[1], seg[3])
+                break
+            if entries is None:
+                return False
+            addr = None
+            size = None
+            for tag, val in entries:
+                if tag == DT_STRTAB:
+                    addr = val
+                elif tag == DT_STRSZ:
+                    size = val
+            if addr is not None and size is not None:
+                offset = self._vaddr_to_offset(segments, addr)
+                if offset is not None:
+                    strtab = self._read(offset, size)
+
+        if strtab is None:
+            raise ElfError("No dynamic string table: {}".format(self.path))
+
+        self.needed = list()
+        self.rpaths = list()
+        for tag, val in entries:
+            if tag == DT_NEEDED:
+                self.needed.append(self._get_string(strtab, val))
+            elif tag == DT_RPATH:
+                self.rpaths.extend(self._get_string(strtab, val).split(":"))
+            elif tag == DT_SONAME:
+                self.soname = self._get_string(strtab, val)
+        return True
+
+    def _read_notes(self, offset, size):
+        """ Yield (name, type, desc) for each note in the given region """
+        blob = self._read(offset, size)
+        pos = 0
+        while pos + 12 <= len(blob):
+            namesz, descsz, n_type = struct.unpack_from(self.endian + "III",
+                                                        blob, pos)
+            pos += 12
+            name = blob[pos:pos + namesz].rstrip("\0")
+            pos += (namesz + 3) & ~3
+            desc = blob[pos:pos + descsz]
+            pos += (descsz + 3) & ~3
+            yield name, n_type, desc
+
+    def get_build_id(self):
+        """ Return the NT_GNU_BUILD_ID as a hex string, or None """
+        regions = [(s[3], s[4]) for s in self.sections() if s[1] == SHT_NOTE]
+        if not regions:
+            regions = [(p[1], p[3]) for p in self.segments()
+                       if p[0] == PT_NOTE]
+        for offset, size in regions:
+            for name, n_type, desc in self._read_notes(offset, size):
+                if name == "GNU" and n_type == NT_GNU_BUILD_ID:
+                    return desc.encode("hex")
+        return None
+
+    def get_section(self, name):
+        """ Return the contents of the named section, or None """
+        sections = self.sections()
+        if self.shstrndx >= len(sections):
+            return None
+        names = sections[self.shstrndx]
+        strtab = self._read(names[3], names[4])
+        for sect in sections:
+            if sect[1] == SHT_NOBITS:
+                continue
+            if self._get_string(strtab, sect[0]) == name:
+                return self._read(sect[3], sect[4])
+        return None
+
+    def get_modinfo(self):
+        """ Return the key/value pairs of a kernel module's .modinfo """
+        ret = dict()
+        data = self.get_section(".modinfo")
+        if not data:
+            return ret
+        for entry in data.split("\0"):
+            if "=" not in entry:
+                continue
+            key, value = entry.split("=", 1)
+            if key not in ret:
+                ret[key] = value
+        return ret
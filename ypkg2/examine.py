@@ -15,22 +15,35 @@ from . import console_ui
 from .metadata import readlink
 from . import remove_prefix
 from . import EMUL32PC
+from .elf import ElfFile, describe_elf_header
+from .examinecache import ExamineCache
+from .pkgconfig import PkgConfigFile, find_pkgconfig
 import magic
 import re
 import os
 import subprocess
 import shutil
 import multiprocessing
+import time
+import stat
 
 global share_ctx
+global share_cache
 
+share_cache = None
+
+# Whether to use the examination cache at all, for lookups and stores alike.
+# Off by default, as a cold chroot never gains from paying to fill it.
+cache_enabled = False
+
+# Searched by pkg-config itself after PKG_CONFIG_PATH, for each ABI. The
+# emul32 build only ever sees EMUL32PC, and must not resolve within lib64.
+SYSTEM_PC_PATHS = ["/usr/lib64/pkgconfig", "/usr/share/pkgconfig"]
+SYSTEM_PC32_PATHS = EMUL32PC.split(":")
 
 v_dyn = re.compile(r"ELF (64|32)\-bit LSB shared object,")
 v_bin = re.compile(r"ELF (64|32)\-bit LSB executable,")
 v_rel = re.compile(r"ELF (64|32)\-bit LSB relocatable,")
-shared_lib = re.compile(r".*Shared library: \[(.*)\].*")
-r_path = re.compile(r".*Library rpath: \[(.*)\].*")
-r_soname = re.compile(r".*Library soname: \[(.*)\].*")
 
 
 def is_pkgconfig_file(pretty, mgs):
@@ -66,6 +79,43 @@ def is_static_archive(file, mgs):
     return True
 
 
+def classify_file(pretty, file, entry=None):
+    """ Return a libmagic compatible description for the given file. The
+        cases examination cares about are recognised from the leading bytes
+        of the file, and libmagic is only consulted when we're unsure. The
+        lstat and link target are taken from the ManifestEntry if given. """
+    if entry:
+        st = entry.st
+    else:
+        st = os.lstat(file)
+    if stat.S_ISLNK(st.st_mode):
+        target = entry.target if entry else os.readlink(file)
+        return "symbolic link to {}".format(target)
+    if stat.S_ISDIR(st.st_mode):
+        return "directory"
+    if not stat.S_ISREG(st.st_mode):
+        return magic.from_file(file)
+    if st.st_size == 0:
+        return "empty"
+
+    with open(file, "rb") as inp:
+        head = inp.read(128)
+
+    desc = describe_elf_header(head)
+    if desc:
+        return desc
+    if head.startswith("!<arch>\n"):
+        return "current ar archive"
+    if pretty.endswith(".la"):
+        if ".la - a libtool library file" in head[0:80]:
+            return "libtool library file, ASCII text"
+        return magic.from_file(file)
+    if "kernel/System.map-" in pretty:
+        return magic.from_file(file)
+    # Nothing else is of interest to examination, spare libmagic the work
+    return "data"
+
+
 def is_system_map(file, mgs):
     """ Ensure we have a system map file """
     if "kernel/System.map-" not in file:
@@ -80,34 +130,51 @@ def is_system_map(file, mgs):
     return True
 
 
-class FileReport:
-
-    pkgconfig_deps = None
-    pkgconfig_name = None
-
-    emul32 = False
-
-    soname = None
-    symbol_deps = None
-
-    rpaths = None
-
-    soname_links = None
-
-    # Dependent kernel versions
-    dep_kernel = None
-    prov_kernel = None
+def intern_field(val):
+    """ Intern report strings, sonames and such repeat across many files """
+    if isinstance(val, str):
+        return intern(val)
+    if isinstance(val, set):
+        return set(intern_field(x) for x in val)
+    return val
+
+
+class FileReport(object):
+    """ Report on a single examined file. These are created in the pool
+        workers and sent back to the parent, so only the fields needed by
+        the DependencyResolver are kept, stored in slots and pickled as a
+        flat tuple. """
+
+    __slots__ = [
+        "pretty",
+        "emul32",
+        "pkgconfig_deps",
+        "pkgconfig_name",
+        # Version constraints on pkgconfig_deps, name -> set((op, version))
+        "pkgconfig_versions",
+        "soname",
+        "symbol_deps",
+        "rpaths",
+        "soname_links",
+        # Dependent kernel versions
+        "dep_kernel",
+        "prov_kernel",
+    ]
+
+    # Fields derived purely from the content of an ELF object
+    cached_fields = ["soname", "symbol_deps", "rpaths", "dep_kernel"]
 
     def scan_kernel(self, file):
         """ Scan a .ko file to figure out which kernel this depends on """
-        cmd = "LC_ALL=C /sbin/modinfo --field=vermagic \"{}\"".format(file)
         try:
-            output = subprocess.check_output(cmd, shell=True)
+            with ElfFile(file) as elf:
+                line = elf.get_modinfo().get("vermagic")
         except Exception as e:
+            line = None
+        if line is None:
             console_ui.emit_warning("File", "Failed to scan kernel modules for"
                                     " path: {}".format(file))
             return
-        line = output.split("\n")[0]
         splits = line.strip().split(" ")
         if "modversions" not in splits:
             return
@@ -116,96 +183,78 @@ class FileReport:
         self.dep_kernel = splits[0].strip()
 
     def scan_binary(self, file, check_soname=False):
-        cmd = "LC_ALL=C /usr/bin/readelf -d \"{}\"".format(file)
+        """ Read the dynamic section directly to find direct dependencies,
+            rpaths and the soname of this binary file """
         try:
-            output = subprocess.check_output(cmd, shell=True)
+            with ElfFile(file) as elf:
+                if not elf.read_dynamic():
+                    return
         except Exception as e:
             console_ui.emit_warning("File", "Failed to scan binary deps for"
                                     " path: {}".format(file))
             return
 
-        for line in output.split("\n"):
-            line = line.strip()
+        if elf.rpaths:
+            if self.rpaths is None:
+                self.rpaths = set()
+            self.rpaths.update(elf.rpaths)
 
-            # Match rpath
-            r = r_path.match(line)
-            if r:
-                if self.rpaths is None:
-                    self.rpaths = set()
-                self.rpaths.update(r.group(1).split(":"))
-                continue
-
-            # Match direct needed dependency
-            m = shared_lib.match(line)
-            if m:
-                if self.symbol_deps is None:
-                    self.symbol_deps = set()
-                self.symbol_deps.add(m.group(1))
-                continue
+        if elf.needed:
+            if self.symbol_deps is None:
+                self.symbol_deps = set()
+            self.symbol_deps.update(elf.needed)
 
-            # Check the soname for this binary file
-            if check_soname:
-                so = r_soname.match(line)
-                if so:
-                    self.soname = so.group(1)
+        # Check the soname for this binary file
+        if check_soname and elf.soname:
+            self.soname = elf.soname
 
     def scan_pkgconfig(self, file):
-        sub = ""
         pcDir = os.path.dirname(file)
         pcPaths = []
         # Ensure we account for private pkgconfig deps too
         if self.emul32:
             pcPaths.append(os.path.join(pcDir, "../../lib32/pkgconfig"))
-            pcPaths.append(EMUL32PC)
+            pcPaths.extend(SYSTEM_PC32_PATHS)
         else:
             pcPaths.append(os.path.join(pcDir, "../../lib64/pkgconfig"))
             pcPaths.append(os.path.join(pcDir, "../../lib/pkgconfig"))
         pcPaths.append(os.path.join(pcDir, "../../share/pkgconfig"))
+        if not self.emul32:
+            pcPaths.extend(SYSTEM_PC_PATHS)
         pkgConfigPaths = []
         for path in pcPaths:
             p = os.path.abspath(path)
             if p and os.path.exists(p) and p not in pkgConfigPaths:
                 pkgConfigPaths.append(p)
 
-        if len(pkgConfigPaths) > 0:
-            sub = "PKG_CONFIG_PATH=\"{}\" ".format(":".join(pkgConfigPaths))
-
-        cmds = [
-            "LC_ALL=C {}pkg-config --print-requires \"{}\"",
-            "LC_ALL=C {}pkg-config --print-requires-private \"{}\""
-        ]
-
         pcname = os.path.basename(file).split(".pc")[0]
         self.pkgconfig_name = pcname
 
         if not share_ctx.spec.pkg_autodep:
             return
-        for cmd in cmds:
-            try:
-                out = subprocess.check_output(cmd.format(sub, file),
-                                              shell=True)
-            except Exception as e:
-                print(e)
-                continue
-            for line in out.split("\n"):
-                line = line.strip()
+        try:
+            pc = PkgConfigFile(file)
+        except Exception as e:
+            console_ui.emit_warning("PKGCONFIG", "Failed to parse {}: {}".
+                                    format(self.pretty, e))
+            return
 
-                if line == "":
-                    continue
-                name = None
-                # In future we'll do something useful with versions
-                if ">=" in line:
-                    name = line.split(">=")[0]
-                elif "=" in line:
-                    # This is an internal dependency
-                    name = line.split("=")[0]
-                else:
-                    name = line
-                name = name.strip()
-
-                if not self.pkgconfig_deps:
-                    self.pkgconfig_deps = set()
-                self.pkgconfig_deps.add(name)
+        for name, op, version in pc.requires + pc.requires_private:
+            if not find_pkgconfig(name, pkgConfigPaths):
+                console_ui.emit_warning("PKGCONFIG", "{} requires unknown "
+                                        "module {}".format(self.pretty, name))
+            if not self.pkgconfig_deps:
+                self.pkgconfig_deps = set()
+            self.pkgconfig_deps.add(name)
+
+            # In future we'll do something useful with versions
+            if op is None:
+                continue
+            if not self.pkgconfig_versions:
+                self.pkgconfig_versions = dict()
+            if name not in self.pkgconfig_versions:
+                self.pkgconfig_versions[name] = set()
+            self.pkgconfig_versions[name].add((op, version))
 
     def add_solink(self, file, pretty):
         """ .so links are almost always split into -devel subpackages in ypkg,
@@ -226,7 +275,7 @@ class FileReport:
         fobj = os.path.join(dirn, fpath)
 
         try:
-            mg = magic.from_file(fobj)
+            mg = classify_file(fobj, fobj)
         except Exception as e:
             return
 
@@ -240,13 +289,47 @@ class FileReport:
     def add_kernel_prov(self, file):
         self.prov_kernel = str(file.split("System.map-")[1])
 
-    def __init__(self, pretty, file, mgs):
+    def get_cached_fields(self):
+        """ Serialisable form of the content derived fields """
+        ret = dict()
+        for field in self.cached_fields:
+            val = getattr(self, field)
+            if isinstance(val, set):
+                val = sorted(val)
+            ret[field] = val
+        return ret
+
+    def restore_cached_fields(self, fields):
+        """ Restore fields previously produced by get_cached_fields """
+        for field in self.cached_fields:
+            val = fields.get(field)
+            if isinstance(val, list):
+                val = set(str(x) for x in val)
+            elif val is not None:
+                val = str(val)
+            setattr(self, field, val)
+
+    def __getstate__(self):
+        return tuple(getattr(self, x) for x in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, val in zip(self.__slots__, state):
+            if val:
+                val = intern_field(val)
+            setattr(self, slot, val)
+
+    def __init__(self, pretty, file, mgs, cached=None):
         global share_ctx
+        for slot in self.__slots__:
+            setattr(self, slot, None)
         self.pretty = pretty
-        self.file = file
+        self.emul32 = False
 
         if pretty.startswith("/usr/lib32/") or pretty.startswith("/lib32"):
             self.emul32 = True
+        if cached is not None:
+            self.restore_cached_fields(cached)
+            return
         if is_pkgconfig_file(pretty, mgs):
             self.scan_pkgconfig(file)
         if is_system_map(pretty, mgs):
@@ -264,6 +347,17 @@ class FileReport:
                 self.scan_kernel(file)
 
 
+def get_strip_flags(mode):
+    """ Flags understood by both strip and objcopy for a given mode """
+    if mode == "shared":
+        return "--strip-unneeded"
+    elif mode == "ko":
+        return "-g --strip-unneeded"
+    elif mode == "ar":
+        return "--strip-debug"
+    return "--strip-all"
+
+
 def strip_file(context, pretty, file, magic_string, mode=None):
     """ Schedule a strip, basically. """
     if not context.spec.pkg_strip:
@@ -278,13 +372,7 @@ def strip_file(context, pretty, file, magic_string, mode=None):
                 "NM=\"gcc-nm\""])
 
     cmd = "{} strip {} \"{}\""
-    flags = ""
-    if mode == "shared":
-        flags = "--strip-unneeded"
-    elif mode == "ko":
-        flags = "-g --strip-unneeded"
-    elif mode == "ar":
-        flags = "--strip-debug"
+    flags = get_strip_flags(mode)
     try:
         s = " ".join(exports)
         subprocess.check_call(cmd.format(s, flags, file), shell=True)
@@ -297,24 +385,84 @@ def strip_file(context, pretty, file, magic_string, mode=None):
 
 def get_debug_path(context, file, magic_string):
     """ Grab the NT_GNU_BUILD_ID """
-    cmd = "LC_ALL=C readelf -n \"{}\"".format(file)
     try:
-        lines = subprocess.check_output(cmd, shell=True)
+        with ElfFile(file) as elf:
+            v = elf.get_build_id()
     except Exception as e:
         return None
+    if not v:
+        return None
 
-    for line in lines.split("\n"):
-        if "Build ID:" not in line:
-            continue
-        v = line.split(":")[1].strip()
+    libdir = "/usr/lib"
+    if "ELF 32" in magic_string:
+        libdir = "/usr/lib32"
+
+    path = os.path.join(libdir, "debug", ".build-id", v[0:2], v[2:])
+    return path + ".debug"
+
+
+def process_elf(context, pretty, file, magic_string, mode, did_full):
+    """ Single post-processing stage for an ELF object. The debug file is
+        split out first, then the debuglink is added while stripping, so
+        the object itself is only rewritten once. """
+    start = time.time()
+
+    flags = []
+    if did_full and store_debug(context, file, did_full):
+        flags.append("--add-gnu-debuglink=\"{}\"".format(did_full))
+    if context.spec.pkg_strip:
+        flags.append(get_strip_flags(mode))
+    if len(flags) == 0:
+        return
+
+    cmd = "LC_ALL=C objcopy {} \"{}\"".format(" ".join(flags), file)
+    try:
+        subprocess.check_call(cmd, shell=True)
+    except Exception as e:
+        console_ui.emit_warning("objcopy", "Failed to process '{}'".
+                                format(pretty))
+        print(e)
+        return
+
+    if context.spec.pkg_strip:
+        console_ui.emit_info("Stripped", "{} ({:.2f}s)".
+                             format(pretty, time.time() - start))
 
-        libdir = "/usr/lib"
-        if "ELF 32" in magic_string:
-            libdir = "/usr/lib32"
 
-        path = os.path.join(libdir, "debug", ".build-id", v[0:2], v[2:])
-        return path + ".debug"
-    return None
+def examine_elf(context, pretty, file, mgs, mode):
+    """ Post-process an ELF object and report on it, restoring a previous
+        result from the examination cache when the content is unchanged """
+    global share_cache
+
+    did_full = get_debug_file(context, pretty, file, mgs)
+
+    # Nothing to rewrite, scanning alone is cheap enough
+    cache = share_cache
+    if not context.spec.pkg_strip and not did_full:
+        cache = None
+
+    key = None
+    if cache:
+        did = None
+        if did_full:
+            did = remove_prefix(did_full, context.get_install_dir())
+        options = [mode, pretty, context.spec.pkg_strip, did,
+                   context.spec.pkg_lastrip, context.spec.pkg_autodep]
+        try:
+            key = cache.get_key(file, options)
+        except Exception as e:
+            key = None
+        if key:
+            fields = cache.restore(key, file, did_full)
+            if fields is not None:
+                console_ui.emit_info("Cached", pretty)
+                return FileReport(pretty, file, mgs, cached=fields)
+
+    process_elf(context, pretty, file, mgs, mode, did_full)
+    freport = FileReport(pretty, file, mgs)
+    if key:
+        cache.store(key, file, did_full, freport.get_cached_fields())
+    return freport
 
 
 def examine_file(*args):
@@ -328,17 +476,14 @@ def examine_file(*args):
 
     if v_dyn.match(mgs):
         # Get soname, direct deps and strip
-        store_debug(context, pretty, file, mgs)
-        strip_file(context, pretty, file, mgs, mode="shared")
+        return examine_elf(context, pretty, file, mgs, mode="shared")
     elif v_bin.match(mgs):
         # Get direct deps, and strip
-        store_debug(context, pretty, file, mgs)
-        strip_file(context, pretty, file, mgs, mode="executable")
+        return examine_elf(context, pretty, file, mgs, mode="executable")
     elif v_rel.match(mgs):
         # Kernel object in all probability
         if file.endswith(".ko"):
-            store_debug(context, pretty, file, mgs)
-            strip_file(context, pretty, file, mgs, mode="ko")
+            return examine_elf(context, pretty, file, mgs, mode="ko")
     elif mgs == "current ar archive":
         # Strip only.
         strip_file(context, pretty, file, mgs, mode="ar")
@@ -347,11 +492,13 @@ def examine_file(*args):
     return freport
 
 
-def store_debug(context, pretty, file, magic_string):
+def get_debug_file(context, pretty, file, magic_string):
+    """ Return the full path for the split debug file, or None if we're
+        not generating debug information """
     if not context.can_dbginfo:
-        return
+        return None
     if not context.spec.pkg_debug:
-        return
+        return None
 
     did = get_debug_path(context, file, magic_string)
 
@@ -361,8 +508,11 @@ def store_debug(context, pretty, file, magic_string):
         else:
             did = "/usr/lib/debug/{}.debug".format(pretty)
 
-    did_full = os.path.join(context.get_install_dir(), did[1:])
+    return os.path.join(context.get_install_dir(), did[1:])
+
 
+def store_debug(context, file, did_full):
+    """ Split the debug information out into did_full """
     # Account for race condition in directory creation
     dirs = os.path.dirname(did_full)
     try:
@@ -371,21 +521,35 @@ def store_debug(context, pretty, file, magic_string):
         pass
     if not os.path.exists(dirs):
         console_ui.emit_error("Debug", "Failed to make directory")
-        return
+        return False
 
     cmd = "objcopy --only-keep-debug \"{}\" \"{}\"".format(file, did_full)
     try:
         subprocess.check_call(cmd, shell=True)
     except Exception as e:
         console_ui.emit_warning("objcopy", "Failed --only-keep-debug")
-        return
-    cmd = "objcopy --add-gnu-debuglink=\"{}\" \"{}\"".format(did_full,
-                                                             file)
+        return False
+    return True
+
+
+def classify_file_task(task):
+    """ Pool entry point, classifying a single (package, pretty, path) """
+    pkgName, pretty, fpath = task
     try:
-        subprocess.check_call(cmd, shell=True)
+        # Workers are forked with the manifest as walked in the parent
+        entry = None
+        if share_ctx.manifest:
+            entry = share_ctx.manifest.get_entry(pretty)
+        mgs = classify_file(pretty, fpath, entry)
     except Exception as e:
-        console_ui.emit_warning("objcopy", "Failed --add-gnu-debuglink")
-        return
+        print(e)
+        mgs = None
+    return pkgName, pretty, fpath, mgs
+
+
+def examine_file_task(task):
+    """ Pool entry point, routing the report back to its owning package """
+    return task[0], examine_file(*task)
 
 
 class PackageExaminer:
@@ -432,68 +596,115 @@ class PackageExaminer:
             return True
         return False
 
-    def examine_package(self, context, package):
-        """ Examine the given package and update symbols, etc. """
+    def get_candidates(self, context, package):
+        """ Return the files of the given package that need classifying """
         install_dir = context.get_install_dir()
 
-        global share_ctx
-
-        share_ctx = context
-
-        # Right now we actually only care about magic matching
-        removed = set()
-
-        pool = multiprocessing.Pool()
-        results = list()
-
+        candidates = list()
         for file in package.emit_files():
             if file[0] == '/':
                 file = file[1:]
             fpath = os.path.join(install_dir, file)
-            try:
-                mgs = magic.from_file(fpath)
-            except Exception as e:
-                print(e)
-                continue
-            if self.should_nuke_file(context, "/" + file, fpath, mgs):
-                try:
-                    if os.path.isfile(fpath):
-                        os.unlink(fpath)
-                    else:
-                        shutil.rmtree(fpath)
-                except Exception as e:
-                    console_ui.emit_error("Clean", "Failed to remove unwanted"
-                                          "file: {}".format(e))
-                    return False
-                console_ui.emit_info("Clean", "Removed unwanted file: {}".
-                                     format("/" + file))
-                removed.add("/" + file)
-                continue
-
-            if not self.file_is_of_interest("/" + file, fpath, mgs):
-                continue
-            # Handle this asynchronously
-            results.append(pool.apply_async(examine_file, [
-                           package, "/" + file, fpath, mgs],
-                           callback=None))
+            candidates.append((package.name, "/" + file, fpath))
+        return candidates
 
-        pool.close()
-        pool.join()
-
-        infos = [x.get() for x in results]
+    def nuke_file(self, pretty, fpath):
+        """ Remove an unwanted file from the install tree """
+        try:
+            if os.path.isfile(fpath):
+                os.unlink(fpath)
+            else:
+                shutil.rmtree(fpath)
+        except Exception as e:
+            console_ui.emit_error("Clean", "Failed to remove unwanted"
+                                  "file: {}".format(e))
+            return False
+        console_ui.emit_info("Clean", "Removed unwanted file: {}".
+                             format(pretty))
+        return True
 
-        for r in removed:
-            package.remove_file(r)
-        return infos
+    def examine_package(self, context, package):
+        """ Examine the given package and update symbols, etc. """
+        examinations = self.examine_packages(context, [package])
+        if package.name not in examinations:
+            return False
+        return examinations[package.name]
 
     def examine_packages(self, context, packages):
-        """ Examine all packages, in order to update dependencies, etc """
+        """ Examine all packages, in order to update dependencies, etc.
+            Files from every package share one worker pool so that we keep
+            all cores busy for the entire examination phase. """
         console_ui.emit_info("Examine", "Examining packages")
 
-        examinations = dict()
+        global share_ctx
+        global share_cache
+
+        share_ctx = context
+        share_cache = None
+        if cache_enabled:
+            cache_dir = os.path.join(context.get_cache_dir(), "examine")
+            share_cache = ExamineCache(cache_dir)
+
+        candidates = list()
         for package in packages:
-            ir = self.examine_package(context, package)
-            if not ir:
-                continue
-            examinations[package.name] = ir
+            candidates.extend(self.get_candidates(context, package))
+
+        examinations = dict()
+        if len(candidates) == 0:
+            return examinations
+
+        jobs = multiprocessing.cpu_count()
+
+        pool = multiprocessing.Pool(jobs)
+        try:
+            # Classification happens in the workers, files come back in
+            # order so that removals and the task list remain stable
+            chunksize = max(1, min(256, len(candidates) // (jobs * 4)))
+            tasks = list()
+            removed = dict()
+            failed = set()
+            for pkgName, pretty, fpath, mgs in pool.imap(classify_file_task,
+                                                         candidates,
+                                                         chunksize):
+                if mgs is None or pkgName in failed:
+                    continue
+                if self.should_nuke_file(context, pretty, fpath, mgs):
+                    if not self.nuke_file(pretty, fpath):
+                        failed.add(pkgName)
+                        continue
+                    if context.manifest:
+                        context.manifest.invalidate(pretty)
+                    if pkgName not in removed:
+                        removed[pkgName] = set()
+                    removed[pkgName].add(pretty)
+                    continue
+                if not self.file_is_of_interest(pretty, fpath, mgs):
+                    continue
+                tasks.append((pkgName, pretty, fpath, mgs))
+
+            for package in packages:
+                if package.name in failed or package.name not in removed:
+                    continue
+                for r in removed[package.name]:
+                    package.remove_file(r)
+
+            tasks = [x for x in tasks if x[0] not in failed]
+            chunksize = max(1, min(32, len(tasks) // (jobs * 4)))
+            for pkgName, report in pool.imap_unordered(examine_file_task,
+                                                       tasks, chunksize):
+                if pkgName not in examinations:
+                    examinations[pkgName] = list()
+                examinations[pkgName].append(report)
+                # Stripping rewrites the file in place
+                if context.manifest:
+                    context.manifest.invalidate(report.pretty)
+        finally:
+            pool.close()
+            pool.join()
+        if share_cache:
+            share_cache.prune()
+
+        # Completion order is arbitrary, keep the reports deterministic
+        for pkgName in examinations:
+            examinations[pkgName].sort(key=lambda r: r.pretty)
         return examinations
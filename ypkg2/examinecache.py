@@ -0,0 +1,164 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+from . import console_ui, hash_file
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+# Upper bound for the on-disk cache, oldest entries are evicted first
+DEFAULT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+# Binutils changes may alter the stripped output, so salt keys with them
+CACHE_TOOLS = ["/usr/bin/objcopy"]
+
+
+class ExamineCache:
+    """ Content addressed store of examination results. Entries are keyed by
+        the hash of the file as installed, along with the options that
+        affect how it is processed, and hold the stripped object, the split
+        debug file and the report fields gathered from it. """
+
+    cache_dir = None
+    max_size = DEFAULT_CACHE_SIZE
+    salt = None
+
+    def __init__(self, cache_dir, max_size=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        salts = list()
+        for tool in CACHE_TOOLS:
+            try:
+                st = os.stat(tool)
+                salts.append("{}:{}:{}".format(tool, st.st_size,
+                                               int(st.st_mtime)))
+            except Exception:
+                pass
+        self.salt = ";".join(salts)
+
+    def get_key(self, file, options):
+        """ Compute the cache key for a file and its examination options """
+        digest = hash_file(file, "sha256")
+        opts = hashlib.sha256()
+        opts.update(self.salt)
+        for opt in options:
+            opts.update("\0{}".format(opt))
+        return "{}-{}".format(digest, opts.hexdigest()[0:16])
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_dir, key[0:2], key)
+
+    def restore(self, key, file, debug_file):
+        """ Restore the stripped object and debug file for the given key,
+            returning the cached report fields, or None on a miss. """
+        entry = self.get_entry_path(key)
+        report = os.path.join(entry, "report")
+        if not os.path.exists(report):
+            return None
+        try:
+            with open(report, "r") as inp:
+                fields = json.load(inp)
+            debug = os.path.join(entry, "debug")
+            if debug_file and not os.path.exists(debug):
+                return None
+            self._install(os.path.join(entry, "stripped"), file)
+            if debug_file:
+                self._install(debug, debug_file)
+            # Bump for LRU eviction
+            os.utime(entry, None)
+        except Exception as e:
+            console_ui.emit_warning("Cache", "Failed to restore {}: {}".
+                                    format(file, e))
+            return None
+        return fields
+
+    def store(self, key, file, debug_file, fields):
+        """ Record the processed object, its debug file and report """
+        entry = self.get_entry_path(key)
+        if os.path.exists(entry):
+            return
+        parent = os.path.dirname(entry)
+        try:
+            if not os.path.exists(parent):
+                os.makedirs(parent, mode=00755)
+        except Exception:
+            # Another worker may have raced us here
+            pass
+        tmp = None
+        try:
+            tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+            shutil.copyfile(file, os.path.join(tmp, "stripped"))
+            if debug_file:
+                shutil.copyfile(debug_file, os.path.join(tmp, "debug"))
+            with open(os.path.join(tmp, "report"), "w") as out:
+                json.dump(fields, out)
+            os.rename(tmp, entry)
+            tmp = None
+        except Exception as e:
+            if not os.path.exists(entry):
+                console_ui.emit_warning("Cache", "Failed to store {}: {}".
+                                        format(file, e))
+        finally:
+            if tmp:
+                shutil.rmtree(tmp, ignore_errors=True)
+
+    def _install(self, source, target):
+        """ Atomically replace target with a copy of source, keeping the
+            target's permissions as strip/objcopy would. """
+        dirn = os.path.dirname(target)
+        if not os.path.exists(dirn):
+            os.makedirs(dirn, mode=00755)
+        fd, tmp = tempfile.mkstemp(dir=dirn, prefix=".ypkg-")
+        os.close(fd)
+        try:
+            shutil.copyfile(source, tmp)
+            if os.path.exists(target):
+                shutil.copymode(target, tmp)
+            else:
+                os.chmod(tmp, 00644)
+            os.rename(tmp, target)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def prune(self):
+        """ Evict least recently used entries until we fit in max_size """
+        if not os.path.exists(self.cache_dir):
+            return
+        entries = list()
+        total = 0
+        for prefix in os.listdir(self.cache_dir):
+            pdir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(pdir):
+                continue
+            for key in os.listdir(pdir):
+                entry = os.path.join(pdir, key)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, x))
+                               for x in os.listdir(entry))
+                    entries.append((os.stat(entry).st_mtime, size, entry))
+                except Exception:
+                    continue
+                total += size
+
+        if total <= self.max_size:
+            return
+        for mtime, size, entry in sorted(entries):
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            if total <= self.max_size:
+                break
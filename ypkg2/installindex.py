@@ -0,0 +1,166 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+from . import console_ui
+
+import pisi.context
+import os
+import sqlite3
+
+# Bump whenever the tables change, so an older index is rebuilt
+INDEX_VERSION = 2
+
+INDEX_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS packages "
+    "(name TEXT PRIMARY KEY, version TEXT)",
+    "CREATE TABLE IF NOT EXISTS files "
+    "(path TEXT PRIMARY KEY, package TEXT)",
+    "CREATE TABLE IF NOT EXISTS sonames "
+    "(name TEXT, dir TEXT, package TEXT, PRIMARY KEY (name, dir))",
+    "CREATE TABLE IF NOT EXISTS pkgconfig "
+    "(name TEXT, package TEXT, emul32 INTEGER, PRIMARY KEY (name, emul32))",
+    "CREATE INDEX IF NOT EXISTS files_package ON files (package)",
+    "CREATE INDEX IF NOT EXISTS sonames_package ON sonames (package)",
+    "CREATE INDEX IF NOT EXISTS pkgconfig_package ON pkgconfig (package)",
+]
+
+INDEX_TABLES = ["packages", "files", "sonames", "pkgconfig"]
+
+# Directories searched by default when resolving a soname
+LIBRARY_DIRS = ["/usr/lib64", "/usr/lib", "/usr/lib32"]
+
+
+def get_installed_versions(idb):
+    """ Map each installed package name to its version-release string.
+        This mirrors how InstallDB identifies installed packages, by the
+        name-version-release directories in the packages dir, and falls
+        back to asking the InstallDB directly. """
+    ret = dict()
+    try:
+        pdir = pisi.context.config.packages_dir()
+        for item in os.listdir(pdir):
+            name, version, release = item.rsplit("-", 2)
+            ret[name] = "{}-{}".format(version, release)
+        return ret
+    except Exception:
+        ret = dict()
+    for name in idb.list_installed():
+        version, release, build = idb.get_version(name)
+        ret[name] = "{}-{}".format(version, release)
+    return ret
+
+
+class InstallIndex:
+    """ Persistent index of the installed system, mapping file paths,
+        sonames in the library directories and pkgconfig names to their
+        owning package. It is built from the whole InstallDB on first use,
+        and afterwards only packages that were installed, updated or
+        removed since are refreshed. """
+
+    path = None
+    db = None
+
+    def __init__(self, path):
+        self.path = path
+        dirn = os.path.dirname(path)
+        if not os.path.exists(dirn):
+            os.makedirs(dirn, mode=00755)
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != INDEX_VERSION:
+            for table in INDEX_TABLES:
+                self.db.execute("DROP TABLE IF EXISTS {}".format(table))
+            self.db.execute("PRAGMA user_version = {}".format(INDEX_VERSION))
+        for stmt in INDEX_SCHEMA:
+            self.db.execute(stmt)
+        self.db.commit()
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def update(self, idb):
+        """ Bring the index in line with the InstallDB """
+        installed = get_installed_versions(idb)
+        known = dict(self.db.execute("SELECT name, version FROM packages"))
+
+        stale = [x for x in known if installed.get(x) != known[x]]
+        added = [x for x in installed if x not in known]
+        if not stale and not added:
+            return
+
+        if not known:
+            console_ui.emit_info("Index", "Building installed files index "
+                                 "({} packages)".format(len(added)))
+        else:
+            console_ui.emit_info("Index", "Updating installed files index "
+                                 "({} changed)".format(len(stale) +
+                                                       len(added)))
+        with self.db:
+            for name in stale:
+                for table in ["files", "sonames", "pkgconfig"]:
+                    self.db.execute("DELETE FROM {} WHERE package = ?".
+                                    format(table), (name,))
+                self.db.execute("DELETE FROM packages WHERE name = ?",
+                                (name,))
+                if name in installed:
+                    self.add_package(idb, name, installed[name])
+            for name in added:
+                self.add_package(idb, name, installed[name])
+
+    def add_package(self, idb, name, version):
+        """ Record the files, sonames and pkgconfig providers of a package """
+        paths = ["/" + f.path for f in idb.get_files(name).list]
+        self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?)",
+                            ((x, name) for x in paths))
+
+        sonames = list()
+        for path in paths:
+            dirn, soname = os.path.split(path)
+            if dirn in LIBRARY_DIRS and ".so" in soname:
+                sonames.append((soname, dirn))
+        self.db.executemany("INSERT OR REPLACE INTO sonames VALUES (?, ?, ?)",
+                            ((x, d, name) for x, d in sonames))
+
+        pkg = idb.get_package(name)
+        provides = [(x.om, 0) for x in pkg.providesPkgConfig]
+        provides.extend([(x.om, 1) for x in pkg.providesPkgConfig32])
+        self.db.executemany("INSERT OR REPLACE INTO pkgconfig "
+                            "VALUES (?, ?, ?)",
+                            ((pc, name, e) for pc, e in provides))
+        self.db.execute("INSERT OR REPLACE INTO packages VALUES (?, ?)",
+                        (name, version))
+
+    def get_file_owner(self, path):
+        """ Return the installed package owning path, or None """
+        row = self.db.execute("SELECT package FROM files WHERE path = ?",
+                              (path,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def get_soname_owners(self, soname):
+        """ Map each library directory holding soname to its package """
+        return dict(self.db.execute("SELECT dir, package FROM sonames "
+                                    "WHERE name = ?", (soname,)))
+
+    def get_pkgconfig_provider(self, name, emul32=False):
+        """ Return the installed package providing a pkgconfig name """
+        row = self.db.execute("SELECT package FROM pkgconfig WHERE name = ? "
+                              "AND emul32 = ?",
+                              (name, 1 if emul32 else 0)).fetchone()
+        if row:
+            return row[0]
+        return None
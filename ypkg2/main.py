@@ -12,14 +12,17 @@
 #
 
 from . import console_ui
-from . import remove_prefix
 from .ypkgspec import YpkgSpec
-from .sources import SourceManager
+from .sources import SourceManager, YpkgSource, DEFAULT_FETCH_JOBS
+from .sources import DEFAULT_FETCH_RETRIES, DEFAULT_RETRY_DELAY
 from .ypkgcontext import YpkgContext
 from .scripts import ScriptGenerator
 from .packages import PackageGenerator, PRIORITY_USER
 from .examine import PackageExaminer
+from . import examine
+from .manifest import InstallManifest, KIND_FILE, KIND_EMPTY_DIR
 from . import metadata
+from .compression import get_compressor, CompressionError
 from .dependencies import DependencyResolver
 from . import packager_name, packager_email
 from . import EMUL32PC
@@ -55,6 +58,31 @@ def main():
                         type=int, default=-1)
     parser.add_argument("-D", "--output-dir", type=str,
                         help="Set the output directory for resulting files")
+    parser.add_argument("--compressor", choices=["xz", "pisi"], default="xz",
+                        help="Backend used to compress package payloads")
+    parser.add_argument("--compression-level", type=int, choices=range(0, 10),
+                        help="xz preset level for package payloads, "
+                        "instead of the configured compressionlevel")
+    parser.add_argument("--compression-dict", type=str,
+                        help="xz dictionary size, i.e. 64MiB")
+    parser.add_argument("--fast-compression", action="store_true",
+                        help="Compress quickly, for local or test builds")
+    parser.add_argument("--no-reuse", action="store_true",
+                        help="Rewrite every package, even if unchanged")
+    parser.add_argument("--examine-cache", action="store_true",
+                        help="Cache stripped objects and debug files "
+                        "between builds")
+    parser.add_argument("--fetch-jobs", type=int, default=DEFAULT_FETCH_JOBS,
+                        help="Number of sources to fetch at once")
+    parser.add_argument("--fetch-retries", type=int,
+                        default=DEFAULT_FETCH_RETRIES,
+                        help="Number of times to retry a failed download")
+    parser.add_argument("--fetch-retry-delay", type=int,
+                        default=DEFAULT_RETRY_DELAY,
+                        help="Seconds before the first retry, doubling after")
+    parser.add_argument("--delta-from", type=str, action="append",
+                        help="Emit delta packages against an earlier eopkg, "
+                        "or the newest suitable one in a directory")
     # Main file
     parser.add_argument("filename", help="Path to the ypkg YAML file to build",
                         nargs='?')
@@ -70,6 +98,27 @@ def main():
         show_version()
     if args.timestamp > 0:
         metadata.history_timestamp = args.timestamp
+    YpkgSource.retries = max(0, args.fetch_retries)
+    YpkgSource.retry_delay = max(0, args.fetch_retry_delay)
+    if args.examine_cache:
+        examine.cache_enabled = True
+    if args.no_reuse:
+        metadata.reuse_packages = False
+    if args.delta_from:
+        for path in args.delta_from:
+            if not os.path.exists(path):
+                console_ui.emit_error("Opt", "{} does not exist".format(path))
+                sys.exit(1)
+        metadata.delta_sources = [os.path.abspath(x) for x in args.delta_from]
+
+    try:
+        metadata.compressor = get_compressor(args.compressor,
+                                             args.compression_level,
+                                             args.compression_dict,
+                                             args.fast_compression)
+    except CompressionError as e:
+        console_ui.emit_error("Opt", "Cannot compress packages: {}".format(e))
+        sys.exit(1)
 
     if args.output_dir:
         od = args.output_dir
@@ -97,7 +146,7 @@ def main():
                               "or as the root user (not recommended)")
         sys.exit(1)
 
-    build_package(args.filename, outputDir)
+    build_package(args.filename, outputDir, args.fetch_jobs)
 
 
 def clean_build_dirs(context):
@@ -167,7 +216,7 @@ def execute_step(context, step, step_n, work_dir):
     return True
 
 
-def build_package(filename, outputDir):
+def build_package(filename, outputDir, fetch_jobs=DEFAULT_FETCH_JOBS):
     """ Will in future be moved to a separate part of the module """
     spec = YpkgSpec()
     if not spec.load_from_path(filename):
@@ -227,20 +276,16 @@ def build_package(filename, outputDir):
 
     ctx = YpkgContext(spec)
 
-    need_verify = []
-    for src in manager.sources:
-        if src.cached(ctx):
-            need_verify.append(src)
-            continue
-        if not src.fetch(ctx):
-            console_ui.emit_error("Source", "Cannot continue without sources")
+    if metadata.compressor:
+        try:
+            metadata.compressor.configure(ctx)
+        except CompressionError as e:
+            console_ui.emit_error("Build", "Cannot compress packages: {}".
+                                  format(e))
             sys.exit(1)
-        need_verify.append(src)
 
-    for verify in need_verify:
-        if not verify.verify(ctx):
-            console_ui.emit_error("Source", "Cannot verify sources")
-            sys.exit(1)
+    if not manager.fetch_sources(ctx, jobs=fetch_jobs):
+        sys.exit(1)
 
     steps = {
         'setup': spec.step_setup,
@@ -374,22 +419,13 @@ def build_package(filename, outputDir):
     if os.path.exists(bad_dir):
         shutil.rmtree(bad_dir)
 
-    for root, dirs, files in os.walk(idir):
-        for f in files:
-            fpath = os.path.join(root, f)
-
-            localpath = remove_prefix(fpath, idir)
-            gene.add_file(localpath)
-        if len(dirs) == 0 and len(files) == 0:
+    # Every later phase works from this manifest rather than the disk
+    ctx.manifest = InstallManifest(idir)
+    for localpath, kind in ctx.manifest.scan():
+        if kind == KIND_EMPTY_DIR:
             console_ui.emit_warning("Package", "Including empty directory: {}".
-                                    format(remove_prefix(root, idir)))
-            gene.add_file(remove_prefix(root, idir))
-
-        # Handle symlinks to directories.
-        for d in dirs:
-            fpath = os.path.join(root, d)
-            if os.path.islink(fpath):
-                gene.add_file(remove_prefix(fpath, idir))
+                                    format(localpath))
+        gene.add_file(localpath)
 
     if not os.path.exists(ctx.get_packaging_dir()):
         try:
@@ -423,13 +459,9 @@ def build_package(filename, outputDir):
             fpath = os.path.join(ctx.get_install_dir(), dbg[1:])
             if not os.path.exists(fpath):
                 continue
-            for root, dirs, files in os.walk(fpath):
+            for localpath, kind in ctx.manifest.scan(fpath):
                 # Empty directories in dbginfo we don't care about.
-                for f in files:
-                    fpath = os.path.join(root, f)
-
-                    localpath = remove_prefix(fpath, idir)
-
+                if kind == KIND_FILE:
                     gene.add_file(localpath)
 
     if len(gene.packages) == 0:
@@ -441,14 +473,16 @@ def build_package(filename, outputDir):
 
     gene.emit_packages()
     # TODO: Ensure main is always first
+    emit = list()
     for package in sorted(gene.packages):
         pkg = gene.packages[package]
-        files = sorted(pkg.emit_files())
+        files = pkg.emit_files()
         if len(files) == 0:
             console_ui.emit_info("Package", "Skipping empty package: {}".
                                  format(package))
             continue
-        metadata.create_eopkg(ctx, gene, pkg, outputDir)
+        emit.append(pkg)
+    metadata.create_eopkgs(ctx, gene, emit, outputDir)
 
     # Write out the final pspec
     metadata.write_spec(ctx, gene, outputDir)
@@ -460,6 +494,12 @@ def build_package(filename, outputDir):
         console_ui.emit_warning("Package:{}".format(pkg),
                                 "Did not produce {} by any pattern".format(nm))
 
+    if ctx.manifest.hashed_bytes > 0:
+        console_ui.emit_info("Package", "Hashed {:.1f} MB at {:.1f} MB/s".
+                             format(ctx.manifest.hashed_bytes /
+                                    (1024.0 * 1024.0),
+                                    ctx.manifest.get_hash_rate()))
+
     # TODO: Consider warning about unused patterns
     ctx.clean_pkg()
     console_ui.emit_success("Package", "Building complete")
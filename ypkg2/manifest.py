@@ -0,0 +1,187 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+from . import remove_prefix, hash_file
+
+from multiprocessing.pool import ThreadPool
+import hashlib
+import multiprocessing
+import os
+import stat
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Kinds of path yielded by InstallManifest.scan
+KIND_FILE = "file"
+KIND_EMPTY_DIR = "emptydir"
+KIND_DIR_LINK = "dirlink"
+
+
+class ManifestEntry(object):
+    """ A single path within the install tree, along with the lstat result
+        and symlink target gathered when it was first seen. The content
+        hash is only computed when something asks for it. """
+
+    __slots__ = ["path", "full_path", "st", "target", "hash"]
+
+    def __init__(self, path, full_path, st=None):
+        self.path = path
+        self.full_path = full_path
+        self.st = st if st is not None else os.lstat(full_path)
+        self.target = None
+        self.hash = None
+        if stat.S_ISLNK(self.st.st_mode):
+            self.target = os.readlink(full_path)
+
+    def is_link(self):
+        return self.target is not None
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.st.st_mode)
+
+    def get_size(self):
+        """ Size as recorded by eopkg, the link length for symlinks """
+        if self.is_link():
+            return long(len(os.path.normpath(self.target)))
+        return long(self.st.st_size)
+
+    def get_hash(self):
+        """ Return the SHA1 as eopkg records it. Symlinks hash their target
+            and directories have no hash at all. """
+        if self.hash is not None or self.is_dir():
+            return self.hash
+        if self.is_link():
+            target = os.path.normpath(self.target)
+            self.hash = hashlib.sha1(target).hexdigest()
+        else:
+            self.hash = hash_file(self.full_path, "sha1")
+        return self.hash
+
+
+class InstallManifest:
+    """ Record of the install tree, built by a single walk and then shared
+        by every packaging phase so that each path is only stat'ed once.
+        Anything that rewrites or removes a file in the tree must call
+        invalidate() for it. """
+
+    root = None
+    entries = None
+
+    # Totals for hash_paths, for reporting throughput
+    hashed_bytes = 0
+    hash_time = 0.0
+
+    def __init__(self, root):
+        self.root = root
+        self.entries = dict()
+
+    def _list_dir(self, directory):
+        """ Yield (name, full path, lstat, is directory) for each child """
+        if scandir is not None:
+            for entry in scandir(directory):
+                st = entry.stat(follow_symlinks=False)
+                yield entry.name, entry.path, st, entry.is_dir()
+            return
+        for name in os.listdir(directory):
+            fpath = os.path.join(directory, name)
+            st = os.lstat(fpath)
+            isdir = stat.S_ISDIR(st.st_mode)
+            if stat.S_ISLNK(st.st_mode):
+                isdir = os.path.isdir(fpath)
+            yield name, fpath, st, isdir
+
+    def scan(self, directory=None):
+        """ Walk the tree (or a directory within it), recording every path,
+            and return (path, kind) for those that should be packaged. This
+            matches os.walk: regular files and dangling links are files,
+            links to directories are not descended, and empty directories
+            are reported so that they can be kept. """
+        if directory is None:
+            directory = self.root
+        ret = list()
+        pending = [directory]
+        while pending:
+            current = pending.pop(0)
+            dirs = list()
+            files = list()
+            for name, fpath, st, isdir in self._list_dir(current):
+                path = remove_prefix(fpath, self.root)
+                self.entries[path] = ManifestEntry(path, fpath, st)
+                if isdir:
+                    dirs.append((fpath, stat.S_ISLNK(st.st_mode)))
+                else:
+                    files.append(path)
+
+            ret.extend((x, KIND_FILE) for x in files)
+            if len(dirs) == 0 and len(files) == 0:
+                ret.append((remove_prefix(current, self.root), KIND_EMPTY_DIR))
+
+            subdirs = list()
+            for fpath, islink in dirs:
+                if islink:
+                    ret.append((remove_prefix(fpath, self.root),
+                                KIND_DIR_LINK))
+                else:
+                    subdirs.append(fpath)
+            pending[0:0] = subdirs
+        return ret
+
+    def get_entry(self, path):
+        """ Return the entry for a packaged path, stat'ing it on demand if
+            it appeared after the walk or was invalidated """
+        if path not in self.entries:
+            fpath = os.path.join(self.root, path.lstrip("/"))
+            self.entries[path] = ManifestEntry(path, fpath)
+        return self.entries[path]
+
+    def hash_paths(self, paths):
+        """ Compute the hashes of the given paths ahead of use. hashlib drops
+            the GIL while digesting large buffers, as does reading, so a
+            thread pool keeps every core busy without pickling anything.
+            The largest files are handed out first to avoid a long tail. """
+        todo = list()
+        for path in paths:
+            entry = self.get_entry(path)
+            if entry.hash is None and not entry.is_dir():
+                todo.append(entry)
+        if not todo:
+            return
+        todo.sort(key=lambda e: e.st.st_size, reverse=True)
+
+        start = time.time()
+        pool = ThreadPool(multiprocessing.cpu_count())
+        try:
+            pool.map(ManifestEntry.get_hash, todo, 1)
+        finally:
+            pool.close()
+            pool.join()
+        self.hash_time += time.time() - start
+        self.hashed_bytes += sum(e.st.st_size for e in todo
+                                 if not e.is_link())
+
+    def get_hash_rate(self):
+        """ Hashing throughput so far, in MB/s """
+        if self.hash_time <= 0:
+            return 0.0
+        return self.hashed_bytes / self.hash_time / (1024 * 1024)
+
+    def invalidate(self, path):
+        """ Forget what we know about path, as it has changed on disk """
+        self.entries.pop(path, None)
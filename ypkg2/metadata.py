@@ -12,6 +12,10 @@
 
 from . import console_ui, pkgconfig_dep, pkgconfig32_dep
 from . import packager_name, packager_email
+from .buildstate import BuildState, get_package_digest
+from .compression import PayloadCompressor, PAYLOAD_NAME
+from .xmlstream import ListTemplate, LineTemplate, XmlTemplateError
+from .xmlstream import get_sentinel, get_probe, read_escapes
 
 import os
 import pisi.util
@@ -24,7 +28,11 @@ import subprocess
 from collections import OrderedDict
 import datetime
 import calendar
+import copy
+import multiprocessing
+import StringIO
 import sys
+import tempfile
 
 
 FileTypes = OrderedDict([
@@ -54,6 +62,15 @@ fallback_date = None
 
 accum_packages = dict()
 
+# PayloadCompressor used for install.tar.xz, set from the command line
+compressor = None
+
+# Whether unchanged eopkgs from the previous build may be kept
+reuse_packages = True
+
+# Earlier eopkgs, or directories holding them, to emit delta packages from
+delta_sources = list()
+
 
 def unix_seconds_for_date(date):
     tp = datetime.datetime.timetuple(date)
@@ -109,26 +126,82 @@ def readlink(path):
     return os.path.normpath(os.readlink(path))
 
 
-def create_files_xml(context, package):
-    """ Create an XML representation of our files """
-    files = pisi.files.Files()
-    global history_timestamp
+def get_staging_dir(context, package):
+    """ Each package is assembled in its own directory beneath the packaging
+        directory, allowing them to be written concurrently """
+    pdir = os.path.join(context.get_packaging_dir(), package.name)
+    if not os.path.exists(pdir):
+        os.makedirs(pdir, mode=00755)
+    return pdir
+
+
+class FilesRecord:
+    """ What later steps need to know of a written files.xml, without
+        keeping a FileInfo around for every file in the package """
+
+    def __init__(self):
+        self.paths = list()
+        self.installed_size = 0
+
+        # (lstat, link target) of each path from the manifest, for the
+        # payload writer, or None where the manifest isn't in use
+        self.stats = list()
 
+        # Entries still awaiting their hashes, when those are deferred
+        self.entries = None
+
+
+def clean_static_archives(context, package):
+    """ Zero the member timestamps of each static archive in the package,
+        exactly as pisi.util.calculate_hash would before hashing it. This
+        must happen before anything hashes or archives the files, so that
+        both files.xml and the payload are reproducible. """
+    for path in package.emit_files():
+        if not path.endswith(".a"):
+            continue
+        full_path = os.path.join(context.get_install_dir(), path.lstrip("/"))
+        if context.manifest:
+            entry = context.manifest.get_entry(path)
+            if not stat.S_ISREG(entry.st.st_mode):
+                continue
+        elif os.path.islink(full_path) or not os.path.isfile(full_path):
+            continue
+        pisi.util.clean_ar_timestamps(full_path)
+        if context.manifest:
+            context.manifest.invalidate(path)
+
+
+def iter_file_info(context, package, record, with_hashes=True):
+    """ Yield the files.xml fields for each file in the package, noting
+        each one in record as we go """
     # TODO: Remove reliance on pisi.util functions completely.
 
-    for path in sorted(package.emit_files()):
+    clean_static_archives(context, package)
+
+    if context.manifest and with_hashes:
+        context.manifest.hash_paths(package.emit_files())
+
+    for path in package.emit_files():
         if path[0] == '/':
             path = path[1:]
 
         full_path = os.path.join(context.get_install_dir(), path)
-        fpath, hash = pisi.util.calculate_hash(full_path)
-
-        if os.path.islink(fpath):
-            fsize = long(len(readlink(full_path)))
-            st = os.lstat(fpath)
+        if context.manifest:
+            entry = context.manifest.get_entry("/" + path)
+            hash = entry.get_hash() if with_hashes else None
+            fsize = entry.get_size()
+            st = entry.st
         else:
-            fsize = long(os.path.getsize(full_path))
-            st = os.stat(fpath)
+            if with_hashes:
+                fpath, hash = pisi.util.calculate_hash(full_path)
+            else:
+                fpath, hash = full_path, None
+            if os.path.islink(fpath):
+                fsize = long(len(readlink(full_path)))
+                st = os.lstat(fpath)
+            else:
+                fsize = long(os.path.getsize(full_path))
+                st = os.stat(fpath)
 
         permanent = package.is_permanent("/" + path)
         if not permanent:
@@ -142,18 +215,134 @@ def create_files_xml(context, package):
             console_ui.emit_warning("Package", "{} has suid bit set".
                                     format(full_path))
 
+        record.paths.append(path.decode("latin1"))
+        record.installed_size += fsize
+        if context.manifest:
+            record.stats.append((entry.st, entry.target))
+        else:
+            record.stats.append(None)
+
         path = path.decode("latin1").encode('utf-8')
-        file_info = pisi.files.FileInfo(path=path, type=ftype,
-                                        permanent=permanent, size=fsize,
-                                        hash=hash, uid=str(st.st_uid),
-                                        gid=str(st.st_gid),
-                                        mode=oct(stat.S_IMODE(st.st_mode)))
-        files.append(file_info)
+        yield dict(path=path, type=ftype, permanent=permanent, size=fsize,
+                   hash=hash, uid=str(st.st_uid), gid=str(st.st_gid),
+                   mode=oct(stat.S_IMODE(st.st_mode)))
+
+
+# Sample values for the numeric Size of the files.xml template
+FILES_SIZE_SENTINEL = 987654320123L
+FILES_SIZE_PROBE = 987654320124L
+
+files_template = None
+
+# Entries written both ways to check the template against pisi itself
+FILES_CHECK_ENTRIES = [
+    dict(path="usr/bin/ypkg-check", type="executable", permanent=None,
+         size=1234L, hash="da39a3ee5e6b4b0d3255bfef95601890afd80709",
+         uid="0", gid="0", mode="0755"),
+    dict(path="usr/share/doc/a & b <\"c\"> 'd' caf\xc3\xa9.txt",
+         type="doc", permanent="true", size=0L,
+         hash="adc83b19e793491b1c6ea0fd8b46cd9f32e592fc", uid="1000",
+         gid="100", mode="0644"),
+    dict(path="usr/share/ypkg-check", type="data", permanent=None,
+         size=4096L, hash=None, uid="0", gid="0", mode="0755"),
+]
+
+
+def check_files_template(context, template):
+    """ Ensure the template renders exactly what pisi writes for a sample
+        package, raising XmlTemplateError if it does not """
+    files = pisi.files.Files()
+    for entry in FILES_CHECK_ENTRIES:
+        files.append(pisi.files.FileInfo(**entry))
+    expected = serialize_xml(context, files)
+
+    out = StringIO.StringIO()
+    template.write(out, FILES_CHECK_ENTRIES)
+    if out.getvalue() != expected:
+        raise XmlTemplateError("Streamed files.xml differs from pisi's")
+
+
+def get_files_template(context):
+    """ Build the streaming template for files.xml from a sample document
+        serialised by pisi itself, or return None if we can't """
+    global files_template
+
+    if files_template is not None:
+        return files_template
+
+    sentinels = dict()
+    for field in ["path", "type", "permanent", "hash", "uid", "gid", "mode"]:
+        sentinels[field] = get_sentinel(field)
+    sentinels["size"] = str(FILES_SIZE_SENTINEL)
+
+    # Anything going wrong here just means we use pisi's object tree
+    try:
+        files = pisi.files.Files()
+        for sample, size in [(get_sentinel, FILES_SIZE_SENTINEL),
+                             (get_probe, FILES_SIZE_PROBE)]:
+            files.append(pisi.files.FileInfo(path=sample("path"),
+                                             type=sample("type"),
+                                             permanent=sample("permanent"),
+                                             size=size, hash=sample("hash"),
+                                             uid=sample("uid"),
+                                             gid=sample("gid"),
+                                             mode=sample("mode")))
+        text = serialize_xml(context, files)
+        template = ListTemplate(text, "File", sentinels, "path")
+        check_files_template(context, template)
+        files_template = template
+    except Exception as e:
+        console_ui.emit_warning("Package", "Not streaming files.xml: {}".
+                                format(e))
+        files_template = False
+    return files_template
+
+
+def serialize_xml(context, doc):
+    """ Return the text pisi writes for the given document """
+    fd, tmp = tempfile.mkstemp(dir=context.get_packaging_dir(),
+                               prefix=".ypkg-", suffix=".xml")
+    os.close(fd)
+    try:
+        doc.write(tmp)
+        with open(tmp, "r") as inp:
+            return inp.read()
+    finally:
+        os.unlink(tmp)
+
+
+def write_files_xml(pdir, entries, timestamp):
+    """ Write files.xml from an iterable of field dicts. Entries are
+        streamed out as they come, rather than held as one object tree. """
+    fpath = os.path.join(pdir, "files.xml")
+    if files_template:
+        with open(fpath, "w") as out:
+            files_template.write(out, entries)
+    else:
+        files = pisi.files.Files()
+        for entry in entries:
+            files.append(pisi.files.FileInfo(**entry))
+        files.write(fpath)
+    os.utime(fpath, (timestamp, timestamp))
+
+
+def create_files_xml(context, package, defer_hashes=False):
+    """ Create an XML representation of our files. With defer_hashes, the
+        entries are kept on the returned record instead, for write_eopkg
+        to complete with hashes taken while archiving each file. """
+    global history_timestamp
+
+    record = FilesRecord()
+    entries = iter_file_info(context, package, record, not defer_hashes)
+    get_files_template(context)
 
-    fpath = os.path.join(context.get_packaging_dir(), "files.xml")
-    files.write(fpath)
-    os.utime(fpath, (history_timestamp, history_timestamp))
-    return files
+    if defer_hashes:
+        record.entries = list(entries)
+        return record
+
+    pdir = get_staging_dir(context, package)
+    write_files_xml(pdir, entries, history_timestamp)
+    return record
 
 
 def create_packager(name, email):
@@ -363,8 +552,7 @@ def create_meta_xml(context, gene, package, files):
     meta = metadata_from_package(context, package, files)
     config = context.pconfig
 
-    iSize = sum([x.size for x in files.list])
-    meta.package.installedSize = iSize
+    meta.package.installedSize = files.installed_size
 
     meta.package.buildHost = config.values.build.build_host
 
@@ -376,50 +564,68 @@ def create_meta_xml(context, gene, package, files):
 
     handle_dependencies(context, gene, meta, package, files)
 
-    mpath = os.path.join(context.get_packaging_dir(), "metadata.xml")
+    mpath = os.path.join(get_staging_dir(context, package), "metadata.xml")
     meta.write(mpath)
     os.utime(mpath, (history_timestamp, history_timestamp))
 
     return meta
 
 
-def create_eopkg(context, gene, package, outputDir):
-    """ Do the hard work and write the package out """
+def get_payload_identity():
+    """ Describe how payloads are being compressed """
+    return (compressor if compressor else PayloadCompressor()).get_identity()
+
+
+def prepare_eopkg(context, gene, package, outputDir, state=None):
+    """ Write out the files.xml and metadata.xml for a package, returning
+        the task for write_eopkg to produce the archive itself along with
+        the installed size of the package. The task is None when the eopkg
+        from the previous build, known to state, can be reused as is. """
     global history_timestamp
 
     name = construct_package_name(context, package)
     fpath = os.path.join(outputDir, name)
 
-    if os.path.abspath(os.path.dirname(fpath)) == os.path.abspath(os.getcwd()):
-        console_ui.emit_info("Package", "Creating {} ...".format(name))
-    else:
-        console_ui.emit_info("Package", "Creating {} ...".format(fpath))
+    # A package we might reuse needs its hashes up front to compare them
+    pdir = get_staging_dir(context, package)
+    check = state is not None and state.has_package(fpath)
+    defer = not check and compressor is not None and compressor.hashes_members
 
     # Grab Files XML
-    pdir = context.get_packaging_dir()
-    files = create_files_xml(context, package)
+    files = create_files_xml(context, package, defer_hashes=defer)
     # Grab Meta XML
     meta = create_meta_xml(context, gene, package, files)
-    # Start creating a package.
 
-    try:
-        pkg = pisi.package.Package(fpath, "w",
-                                   format=pisi.package.Package.default_format,
-                                   tmp_dir=pdir)
-    except Exception as e:
-        console_ui.emit_error("Build", "Failed to emit package: {}".
-                              format(e))
-        sys.exit(1)
+    if check:
+        digest = get_package_digest(pdir, history_timestamp,
+                                    get_payload_identity())
+        if state.is_current(fpath, digest):
+            console_ui.emit_info("Package", "Reusing unchanged {}".
+                                 format(name))
+            state.record(fpath, digest)
+            return None, meta.package.installedSize
 
-    if history_timestamp:
-        pkg.history_timestamp = history_timestamp
+    if os.path.abspath(os.path.dirname(fpath)) == os.path.abspath(os.getcwd()):
+        console_ui.emit_info("Package", "Creating {} ...".format(name))
+    else:
+        console_ui.emit_info("Package", "Creating {} ...".format(fpath))
 
-    pkg.add_metadata_xml(os.path.join(pdir, "metadata.xml"))
-    pkg.add_files_xml(os.path.join(pdir, "files.xml"))
+    task = [fpath, pdir, context.get_install_dir(), history_timestamp,
+            files, None]
+    return task, meta.package.installedSize
 
-    for finfo in pkg.files.list:
+
+def write_eopkg(task):
+    """ Write the eopkg archive from its staging directory. This is a pool
+        entry point, so failures are returned as a message rather than
+        exiting from within the worker, along with the compression stats """
+    fpath, pdir, install_dir, history_timestamp, files, payload = task
+
+    lstats = files.stats if files.stats else [None] * len(files.paths)
+    members = list()
+    for path, lstat in zip(files.paths, lstats):
         # old eopkg trick to ensure the file names are all valid
-        orgname = os.path.join(context.get_install_dir(), finfo.path)
+        orgname = os.path.join(install_dir, path)
         orgname = orgname.encode('utf-8').decode('utf-8').encode("latin1")
 
         # if os.path.islink(orgname) and not os.path.isdir(orgname):
@@ -437,18 +643,323 @@ def create_eopkg(context, gene, package, outputDir):
         #         console_ui.emit_warning("utime", "Failed to modify utime")
         #         print("Reproducible builds will be affected: {}".format(e))
 
-        pkg.add_to_install(orgname, finfo.path)
+        members.append((orgname, path, lstat))
+
+    # Archiving each file hashes it too, so files.xml is completed from
+    # that single read before it goes into the package.
+    pfile = None
+    stats = None
+    if files.entries is not None:
+        try:
+            pfile, stats, hashes = payload.create_payload(pdir, members,
+                                                          history_timestamp)
+            entries = (dict(x, hash=h) for x, h in zip(files.entries, hashes))
+            write_files_xml(pdir, entries, history_timestamp)
+        except Exception as e:
+            return "Failed to emit package: {}".format(e), None
 
-    pfile = os.path.join(pdir, "install.tar.xz")
-    os.utime(pfile, (history_timestamp, history_timestamp))
+    # Start creating a package.
     try:
-        pkg.close()
+        pkg = pisi.package.Package(fpath, "w",
+                                   format=pisi.package.Package.default_format,
+                                   tmp_dir=pdir)
     except Exception as e:
-        console_ui.emit_error("Build", "Failed to emit package: {}".
-                              format(e))
+        return "Failed to emit package: {}".format(e), None
+
+    if history_timestamp:
+        pkg.history_timestamp = history_timestamp
+
+    try:
+        pkg.add_metadata_xml(os.path.join(pdir, "metadata.xml"))
+        # files.xml is added as-is, there's no need to parse it all back in
+        pkg.add_to_package(os.path.join(pdir, "files.xml"), "files.xml")
+
+        if pfile:
+            pkg.add_to_package(pfile, PAYLOAD_NAME)
+            pkg.close()
+            os.unlink(pfile)
+        elif not members:
+            # Nothing to carry, i.e. a delta where no file changed, so the
+            # package holds metadata alone as eopkg's own deltas would
+            pkg.close()
+        else:
+            stats = payload.write_payload(pkg, pdir, members,
+                                          history_timestamp)
+    except Exception as e:
+        return "Failed to emit package: {}".format(e), None
+    return None, stats
+
+
+def construct_delta_name(context, package, old_release):
+    """ .delta.eopkg path, named for the release it updates from """
+    name = context.spec.get_package_name(package.name)
+    config = context.pconfig
+
+    parts = [
+              name,
+              str(old_release),
+              str(context.spec.pkg_release),
+              config.values.general.distribution_release,
+              config.values.general.architecture]
+    return "{}.delta.eopkg".format("-".join(parts))
+
+
+def find_delta_base(context, package, tmp_dir):
+    """ Find the newest earlier release of package within delta_sources,
+        returning its path and release, or None. Only the metadata of each
+        candidate is read. """
+    name = context.spec.get_package_name(package.name)
+    release = int(context.spec.pkg_release)
+
+    candidates = list()
+    for source in delta_sources:
+        if os.path.isdir(source):
+            candidates.extend(os.path.join(source, x)
+                              for x in sorted(os.listdir(source)))
+        else:
+            candidates.append(source)
+
+    ret = None
+    for path in candidates:
+        fname = os.path.basename(path)
+        if not fname.startswith(name + "-") or not fname.endswith(".eopkg"):
+            continue
+        if fname.endswith(".delta.eopkg"):
+            continue
+        try:
+            meta = pisi.package.Package(path, "r",
+                                        tmp_dir=tmp_dir).get_metadata()
+        except Exception as e:
+            console_ui.emit_warning("Delta", "Cannot read {}: {}".
+                                    format(path, e))
+            continue
+        if meta.package.name != name:
+            continue
+        old_release = int(meta.package.release)
+        if old_release >= release:
+            continue
+        if ret is None or old_release > ret[1]:
+            ret = (path, old_release)
+    return ret
+
+
+def get_delta_files(old_files, new_files):
+    """ The files of the new package that a delta must carry. As with eopkg
+        itself, that is every file whose hash the old package lacks. """
+    old_hashes = set(x.hash for x in old_files.list)
+    return [x for x in new_files.list if x.hash not in old_hashes]
+
+
+def prepare_delta(context, package, outputDir):
+    """ Build the write_eopkg task for a delta of package against the
+        newest earlier release available, along with the size of the files
+        it carries, or return None if there is nothing to update from. The
+        new files.xml and metadata.xml are shared with the full package,
+        and the payload of the old one is never unpacked. """
+    global history_timestamp
+
+    # Keep the old package's xml files apart from our own
+    pdir = get_staging_dir(context, package)
+    old_dir = os.path.join(pdir, "delta-base")
+
+    base = find_delta_base(context, package, old_dir)
+    if base is None:
+        return None
+    old_path, old_release = base
+
+    try:
+        old_files = pisi.package.Package(old_path, "r",
+                                         tmp_dir=old_dir).get_files()
+        new_files = pisi.files.Files()
+        new_files.read(os.path.join(pdir, "files.xml"))
+    except Exception as e:
+        console_ui.emit_warning("Delta", "Cannot compare with {}: {}".
+                                format(old_path, e))
+        return None
+
+    files = FilesRecord()
+    for info in get_delta_files(old_files, new_files):
+        files.paths.append(info.path)
+        files.installed_size += long(info.size or 0)
+
+    name = construct_delta_name(context, package, old_release)
+    console_ui.emit_info("Delta", "Creating {} ({} of {} files)".
+                         format(name, len(files.paths), len(new_files.list)))
+    task = [os.path.join(outputDir, name), pdir, context.get_install_dir(),
+            history_timestamp, files, None]
+    return task, files.installed_size
+
+
+def get_emit_jobs(count):
+    """ Number of packages to write concurrently """
+    return max(1, min(count, multiprocessing.cpu_count()))
+
+
+def assign_payloads(tasks, sizes):
+    """ Give each task its own copy of the compressor. Threads are shared
+        out in proportion to package size, so together the compressors use
+        roughly one thread per core and the largest package gets most. """
+    cpus = multiprocessing.cpu_count()
+    total = max(1, sum(sizes))
+    base = compressor if compressor else PayloadCompressor()
+    for task, size in zip(tasks, sizes):
+        payload = copy.copy(base)
+        payload.threads = max(1, int(round(cpus * float(size) / total)))
+        task[5] = payload
+
+
+def create_eopkg(context, gene, package, outputDir):
+    """ Do the hard work and write the package out """
+    create_eopkgs(context, gene, [package], outputDir)
+
+
+def write_eopkgs(tasks, sizes):
+    """ Run write_eopkg for every task, the largest packages first, and
+        report on each. Returns the tasks that succeeded, or None if any of
+        them failed. """
+    ordered = sorted(zip(tasks, sizes), key=lambda t: t[1], reverse=True)
+    sizes = [x[1] for x in ordered]
+    tasks = [x[0] for x in ordered]
+    assign_payloads(tasks, sizes)
+
+    jobs = get_emit_jobs(len(tasks))
+    if jobs == 1:
+        results = [write_eopkg(x) for x in tasks]
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(write_eopkg, tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    failed = False
+    for task, (error, stats) in zip(tasks, results):
+        name = os.path.basename(task[0])
+        if error:
+            console_ui.emit_error("Build", error)
+            failed = True
+            continue
+        if stats:
+            console_ui.emit_info("Compress", "{}: {:.1f} MB to {:.1f} MB "
+                                 "({:.1f}%) in {:.1f}s".
+                                 format(name,
+                                        stats.input_size / (1024.0 * 1024.0),
+                                        stats.output_size / (1024.0 * 1024.0),
+                                        stats.get_ratio(), stats.duration))
+    if failed:
+        return None
+    return tasks
+
+
+def create_eopkgs(context, gene, packages, outputDir):
+    """ Write out all of the given packages. Metadata is produced in order,
+        as it feeds accum_packages and the history timestamp, and then the
+        archives are written concurrently as they are independent of each
+        other. Packages unchanged since the previous build into outputDir
+        are not written again. Deltas follow, if any were requested. """
+    state = BuildState(outputDir) if reuse_packages else None
+    prepared = [prepare_eopkg(context, gene, x, outputDir, state)
+                for x in packages]
+    prepared = [x for x in prepared if x[0] is not None]
+
+    tasks = write_eopkgs([x[0] for x in prepared], [x[1] for x in prepared])
+    if tasks is None:
+        sys.exit(1)
+    if state:
+        for task in tasks:
+            digest = get_package_digest(task[1], task[3],
+                                        task[5].get_identity())
+            state.record(task[0], digest)
+        state.save()
+
+    if not delta_sources:
+        return
+    prepared = [prepare_delta(context, x, outputDir) for x in packages]
+    prepared = [x for x in prepared if x is not None]
+    if write_eopkgs([x[0] for x in prepared],
+                    [x[1] for x in prepared]) is None:
         sys.exit(1)
 
 
+def create_spec_path(path, ftype):
+    """ Factory: Create a pspec Path """
+    fc = pisi.specfile.Path()
+    fc.path = path
+    fc.fileType = ftype
+    return fc
+
+
+# Files of each package, plus these, written both ways to check streaming
+SPEC_CHECK_COUNT = 16
+SPEC_CHECK_PATHS = ["/usr/share/doc/ypkg-check/a & b <\"c\"> 'd'.txt"]
+
+
+def render_spec_streamed(text, out, streamed):
+    """ Write text, the spec as pisi serialised it, to out with the files of
+        each package in streamed, a list of (name, files), rendered in place
+        of their sentinel Path entries """
+    escapes = dict()
+    escapes["path"] = read_escapes(text, "path")
+    escapes["type"] = read_escapes(text, "type")
+    probes = {"path": get_sentinel("path"), "type": get_sentinel("type")}
+
+    for line in text.splitlines(True):
+        if probes["path"] in line:
+            # Drop the escaping probe, after checking it is alone
+            LineTemplate(line, probes, escapes)
+            continue
+        for name, files in streamed:
+            sentinels = {"path": get_sentinel("files:" + name),
+                         "type": probes["type"]}
+            if sentinels["path"] not in line:
+                continue
+            template = LineTemplate(line, sentinels, escapes)
+            if len(template.fields) != 2:
+                raise XmlTemplateError("Unexpected Path entry: {}".
+                                       format(line))
+            for f in files:
+                out.write(template.render(
+                          {"path": f, "type": get_file_type(f)}))
+            break
+        else:
+            out.write(line)
+
+
+def check_spec_streamed(context, spec, text, streamed):
+    """ Ensure streaming renders exactly what pisi writes for the spec with
+        a sample of each package's files, raising XmlTemplateError if it
+        does not """
+    sample = [(pkg, specPkg, list(files[:SPEC_CHECK_COUNT]) +
+               SPEC_CHECK_PATHS) for pkg, specPkg, files in streamed]
+    out = StringIO.StringIO()
+    render_spec_streamed(text, out, [(x[0], x[2]) for x in sample])
+
+    originals = [x[1].files for x in sample]
+    try:
+        for pkg, specPkg, files in sample:
+            specPkg.files = [create_spec_path(f, get_file_type(f))
+                             for f in files]
+        expected = serialize_xml(context, spec)
+    finally:
+        for (pkg, specPkg, files), orig in zip(sample, originals):
+            specPkg.files = orig
+
+    if out.getvalue() != expected:
+        raise XmlTemplateError("Streamed pspec differs from pisi's")
+
+
+def write_spec_streamed(context, spec, opath, streamed):
+    """ Write the spec with the files of each package in streamed, a list of
+        (name, spec package, files), rendered in place of their sentinel
+        Path entries once a sample is known to match pisi's own output """
+    text = serialize_xml(context, spec)
+    if streamed:
+        check_spec_streamed(context, spec, text, streamed)
+    with open(opath, "w") as out:
+        render_spec_streamed(text, out, [(x[0], x[2]) for x in streamed])
+
+
 def write_spec(context, gene, outputDir):
     """ Write out a compatibility pspec_$ARCH.xml """
     global accum_packages
@@ -489,6 +1000,7 @@ def write_spec(context, gene, outputDir):
     for i in gene.packages:
         all_names.add(context.spec.get_package_name(i))
 
+    streamed = list()
     for pkg in packages:
         package = accum_packages[pkg]
 
@@ -503,12 +1015,16 @@ def write_spec(context, gene, outputDir):
                 continue
             setattr(specPkg, item, getattr(package.package, item))
 
-        # Now the fun bit.
-        for f in sorted(gene.packages[pkg].emit_files()):
-            fc = pisi.specfile.Path()
-            fc.path = f
-            fc.fileType = get_file_type(f)
-            specPkg.files.append(fc)
+        # Now the fun bit. Files are streamed into the output in place of
+        # a sentinel, rather than held as a Path object each.
+        files = gene.packages[pkg].emit_files()
+        if files:
+            specPkg.files.append(create_spec_path(
+                get_sentinel("files:" + pkg), get_sentinel("type")))
+            if not streamed:
+                specPkg.files.append(create_spec_path(get_probe("path"),
+                                                      get_probe("type")))
+            streamed.append((pkg, specPkg, files))
         for dep in package.package.packageDependencies:
             if dep.package not in all_names:
                 continue
@@ -518,7 +1034,16 @@ def write_spec(context, gene, outputDir):
 
     opath = os.path.join(outputDir, "pspec_{}.xml".format(context.build.arch))
     try:
-        spec.write(opath)
+        try:
+            write_spec_streamed(context, spec, opath, streamed)
+        except Exception as e:
+            if streamed:
+                console_ui.emit_warning("Package", "Not streaming pspec: {}".
+                                        format(e))
+            for pkg, specPkg, files in streamed:
+                specPkg.files = [create_spec_path(f, get_file_type(f))
+                                 for f in files]
+            spec.write(opath)
     except Exception as e:
         console_ui.emit_error("Build", "Cannot write pspec file")
         print(e)
@@ -15,7 +15,7 @@
 #  (at your option) any later version.
 
 from . import console_ui
-from .stringglob import StringPathGlob
+from .stringglob import StringPathGlob, StringPathGlobSet
 
 import os
 
@@ -47,8 +47,18 @@ class Package:
     # List of permanent files
     permanent = None
 
-    def __init__(self, name):
+    # Shared path -> package name index, maintained for the generator
+    owners = None
+
+    # Compiled form of patterns, rebuilt when a new pattern is seen
+    matcher = None
+
+    # Sorted result of emit_files, dropped whenever the file set changes
+    file_list = None
+
+    def __init__(self, name, owners=None):
         self.name = name
+        self.owners = owners
         self.patterns = dict()
         self.files = set()
         self.excludes = set()
@@ -63,13 +73,12 @@ class Package:
         """ Return a matching pattern for the given path.
             This is ordered according to priority to enable
             multiple layers of priorities """
-        matches = [p for p in self.patterns if p.match(path)]
-        if len(matches) == 0:
+        if self.matcher is None:
+            self.matcher = StringPathGlobSet(self.patterns)
+        match = self.matcher.match(path)
+        if match is None:
             return self.default_policy
-
-        matches = sorted(matches, key=StringPathGlob.get_priority,
-                         reverse=True)
-        return matches[0]
+        return match
 
     def add_file(self, pattern, path, permanent):
         """ Add a file by a given pattern to this package """
@@ -77,11 +86,22 @@ class Package:
             pattern = self.default_policy
         if pattern not in self.patterns:
             self.patterns[pattern] = set()
+            self.matcher = None
         self.patterns[pattern].add(path)
         self.files.add(path)
+        self.file_list = None
+        if self.owners is not None:
+            self.owners[path] = self.name
         if permanent:
             self.permanent.add(path)
 
+    def disown_file(self, path):
+        """ Drop our claim on a path in the shared owner index """
+        if self.owners is None:
+            return
+        if self.owners.get(path) == self.name:
+            del self.owners[path]
+
     def remove_file(self, path):
         """ Remove a file from this package if it owns it """
         pat = self.get_pattern(path)
@@ -89,8 +109,10 @@ class Package:
             return
         if path in self.patterns[pat]:
             self.patterns[pat].remove(path)
+            self.file_list = None
         if path in self.files:
             self.files.remove(path)
+            self.disown_file(path)
 
     def exclude_file(self, path):
         """ Exclude a file from this package if it captures it """
@@ -99,15 +121,23 @@ class Package:
             return
         if path in self.files:
             self.files.remove(path)
-        self.excludes.add(path)
+            self.disown_file(path)
+        if path not in self.excludes:
+            self.excludes.add(path)
+            self.file_list = None
 
     def emit_files(self):
-        """ Emit actual file lists, vs the globs we have """
+        """ Emit actual file lists, vs the globs we have. The sorted list is
+            cached until the package changes, so callers must not modify
+            it. """
+        if self.file_list is not None:
+            return self.file_list
         ret = set()
         for pt in self.patterns:
             adds = [x for x in self.patterns[pt] if x not in self.excludes]
             ret.update(adds)
-        return sorted(ret)
+        self.file_list = sorted(ret)
+        return self.file_list
 
     def is_permanent(self, path):
         """ Determine if a path if a permanent path or not """
@@ -138,10 +168,22 @@ class PackageGenerator:
     packages = None
     permanent = None
 
+    # Reverse index of path -> owning package name
+    owners = None
+
+    # Memoized os.path.realpath lookups for get_file_owner
+    realpaths = None
+
+    # Compiled forms of patterns and permanent, rebuilt on change
+    matcher = None
+    permanent_matcher = None
+
     def __init__(self, spec):
         self.patterns = dict()
         self.packages = dict()
         self.permanent = set()
+        self.owners = dict()
+        self.realpaths = dict()
 
         if spec.pkg_permanent:
             for perm in spec.pkg_permanent:
@@ -234,14 +276,12 @@ class PackageGenerator:
         if pattern:
             target = self.patterns[pattern]
 
-        permanent = False
-        for perm in self.permanent:
-            if perm.match(path):
-                permanent = True
-                break
+        if self.permanent_matcher is None:
+            self.permanent_matcher = StringPathGlobSet(self.permanent)
+        permanent = self.permanent_matcher.match(path) is not None
 
         if target not in self.packages:
-            self.packages[target] = Package(target)
+            self.packages[target] = Package(target, self.owners)
         self.packages[target].add_file(pattern, path, permanent)
 
     def remove_file(self, path):
@@ -255,13 +295,9 @@ class PackageGenerator:
         """ Return a matching pattern for the given path.
             This is ordered according to priority to enable
             multiple layers of priorities """
-        matches = [p for p in self.patterns if p.match(path)]
-        if len(matches) == 0:
-            return None
-
-        matches = sorted(matches, key=StringPathGlob.get_priority,
-                         reverse=True)
-        return matches[0]
+        if self.matcher is None:
+            self.matcher = StringPathGlobSet(self.patterns)
+        return self.matcher.match(path)
 
     def add_pattern(self, pattern, pkgName, priority=PRIORITY_DEFAULT):
         """ Add a pattern to the internal map according to the
@@ -275,6 +311,7 @@ class PackageGenerator:
 
         obj = StringPathGlob(pattern, prefixMatch=is_prefix, priority=priority)
         self.patterns[obj] = pkgName
+        self.matcher = None
 
     def add_permanent_pattern(self, pattern):
         """ Add a pattern to our mapping of permanent paths. """
@@ -286,6 +323,7 @@ class PackageGenerator:
 
         obj = StringPathGlob(pattern, prefixMatch=is_prefix)
         self.permanent.add(obj)
+        self.permanent_matcher = None
 
     def emit_packages(self):
         """ Ensure we've finalized our state, allowing proper theft and
@@ -294,20 +332,30 @@ class PackageGenerator:
             a "main" package will be generated, as patterns may omit
             the production of one. """
 
-        for package in self.packages:
-            for comparison in self.packages:
-                if comparison == package:
-                    continue
-                for file in self.packages[comparison].emit_files():
-                    self.packages[package].exclude_file(file)
+        # A contested file is kept by the last package to claim it, in
+        # package order, and excluded from every earlier claimant.
+        winners = dict()
+        losers = list()
+        for pkg in self.packages:
+            for file in self.packages[pkg].emit_files():
+                if file in winners:
+                    losers.append((winners[file], file))
+                winners[file] = pkg
+
+        for pkg, file in losers:
+            self.packages[pkg].exclude_file(file)
+
+        # Re-establish the owner index from the final state.
+        self.owners.clear()
+        self.owners.update(winners)
 
     def get_file_owner(self, file):
         """ Return the owning package for the specified file """
-        rname = os.path.realpath(file)
-        for pkg in self.packages:
-            package = self.packages[pkg]
-            if file in package.files:
-                return package
-            elif rname in package.files:
-                return package
+        if file in self.owners:
+            return self.packages[self.owners[file]]
+        if file not in self.realpaths:
+            self.realpaths[file] = os.path.realpath(file)
+        rname = self.realpaths[file]
+        if rname in self.owners:
+            return self.packages[self.owners[rname]]
         return None
@@ -0,0 +1,140 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+import os
+import re
+
+pc_variable = re.compile(r"^([A-Za-z0-9_.]+)\s*=\s*(.*)$")
+pc_keyword = re.compile(r"^([A-Za-z0-9_.]+)\s*:\s*(.*)$")
+pc_reference = re.compile(r"\$\{([^}]*)\}")
+pc_token = re.compile(r"[<>=!]+|[^\s<>=!,]+")
+
+VersionOperators = ["<", "<=", "=", ">=", ">", "!="]
+
+
+class PkgConfigError(Exception):
+    pass
+
+
+class PkgConfigFile:
+    """ In-process parser for pkg-config .pc files, so that we don't need to
+        fork pkg-config itself to learn what a module requires. """
+
+    name = None
+    path = None
+    variables = None
+    fields = None
+
+    # Lists of (name, operator, version) tuples
+    requires = None
+    requires_private = None
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)[:-3]
+        self.variables = dict()
+        self.fields = dict()
+
+        # pkg-config always provides the directory of the .pc file
+        self.variables["pcfiledir"] = os.path.dirname(path)
+
+        self._parse()
+        self.requires = self.parse_module_list(self.fields.get("Requires"))
+        self.requires_private = self.parse_module_list(
+            self.fields.get("Requires.private"))
+
+    def expand(self, value):
+        """ Expand ${variable} references against those defined so far """
+        ret = ""
+        pos = 0
+        while pos < len(value):
+            if value.startswith("$$", pos):
+                ret += "$"
+                pos += 2
+                continue
+            m = pc_reference.match(value, pos)
+            if m:
+                ret += self.variables.get(m.group(1), "")
+                pos = m.end()
+                continue
+            ret += value[pos]
+            pos += 1
+        return ret
+
+    def _lines(self):
+        """ Logical lines of the file, with comments and continuations
+            handled as pkg-config does """
+        with open(self.path, "r") as inp:
+            line = ""
+            for raw in inp:
+                raw = raw.rstrip("\r\n")
+                if raw.endswith("\\"):
+                    line += raw[:-1]
+                    continue
+                line += raw
+                if "#" in line:
+                    line = line[:line.index("#")]
+                yield line.strip()
+                line = ""
+            if line:
+                yield line.strip()
+
+    def _parse(self):
+        for line in self._lines():
+            if not line:
+                continue
+            # Keywords win when ':' comes before any '='
+            colon = line.find(":")
+            equals = line.find("=")
+            if colon >= 0 and (equals < 0 or colon < equals):
+                m = pc_keyword.match(line)
+                if m:
+                    self.fields[m.group(1)] = self.expand(m.group(2).strip())
+                continue
+            m = pc_variable.match(line)
+            if m:
+                self.variables[m.group(1)] = self.expand(m.group(2).strip())
+
+    @staticmethod
+    def parse_module_list(value):
+        """ Split a Requires style value into (name, op, version) tuples """
+        ret = list()
+        if not value:
+            return ret
+        tokens = pc_token.findall(value)
+        i = 0
+        while i < len(tokens):
+            name = tokens[i]
+            i += 1
+            if name in VersionOperators:
+                raise PkgConfigError("Unexpected operator: {}".format(name))
+            op = None
+            version = None
+            if i < len(tokens) and tokens[i] in VersionOperators:
+                op = tokens[i]
+                if i + 1 >= len(tokens):
+                    raise PkgConfigError("Missing version for {}".
+                                         format(name))
+                version = tokens[i + 1]
+                i += 2
+            ret.append((name, op, version))
+        return ret
+
+
+def find_pkgconfig(name, paths):
+    """ Find the .pc file for a module name within the given search paths """
+    for path in paths:
+        fpath = os.path.join(path, "{}.pc".format(name))
+        if os.path.exists(fpath):
+            return fpath
+    return None
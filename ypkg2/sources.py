@@ -11,13 +11,18 @@
 #  (at your option) any later version.
 #
 
-from . import console_ui
+from . import console_ui, atomic_write_json, hash_file
 
+from multiprocessing.pool import ThreadPool
+import errno
 import os
-import hashlib
+import json
 import subprocess
 import fnmatch
 import shutil
+import threading
+import time
+import urlparse
 
 KnownSourceTypes = {
     'tar': [
@@ -29,12 +34,75 @@ KnownSourceTypes = {
     ],
 }
 
+# Verified hashes are recorded alongside the source under this suffix
+VERIFIED_SUFFIX = ".ypkg-verified"
+
+# Bounds on concurrent fetching, overall and against any one host
+DEFAULT_FETCH_JOBS = 4
+DEFAULT_HOST_JOBS = 2
+
+# Failed downloads are retried, waiting twice as long after each attempt
+DEFAULT_FETCH_RETRIES = 3
+DEFAULT_RETRY_DELAY = 5
+
+# Downloads land here first, and are only moved into place once verified
+PARTIAL_SUFFIX = ".part"
+
+# curl exit codes for a resume the server cannot honour
+CURL_RANGE_ERRORS = [33, 36]
+
+
+def ensure_sources_directory(source_dir):
+    """ Create the sources directory if needed. Concurrent fetches may race
+        to do so, which is fine. """
+    try:
+        os.makedirs(source_dir, mode=00755)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(source_dir):
+            console_ui.emit_error("Source", "Cannot create sources "
+                                  "directory: {}".format(e))
+            return False
+    return True
+
+
+def get_source_host(uri):
+    """ Host a source is fetched from, for limiting connections to it """
+    host = urlparse.urlparse(uri).hostname
+    if host:
+        return host
+    # scp-like git locations, i.e. git@github.com:solus-project/ypkg.git
+    if ":" in uri:
+        return uri.split(":")[0].split("@")[-1]
+    return uri
+
+
+def get_file_identity(path):
+    """ Key under which the verified hash of a file remains valid """
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime, st.st_ino]
+
 
 class YpkgSource:
 
+    # Suppress progress output, i.e. when fetching concurrently
+    quiet = False
+
+    # How often, and after how many seconds, a failed download is retried.
+    # Set from the command line.
+    retries = DEFAULT_FETCH_RETRIES
+    retry_delay = DEFAULT_RETRY_DELAY
+
     def __init__(self):
         pass
 
+    def get_host(self):
+        """ Host this source is fetched from """
+        return None
+
+    def get_fetched_size(self, context):
+        """ Size in bytes of what fetch obtained, for reporting """
+        return 0
+
     def fetch(self, context):
         """ Fetch this source from it's given location """
         return False
@@ -74,6 +142,9 @@ class GitSource(YpkgSource):
     def __str__(self):
         return "{} ({})".format(self.uri, self.tag)
 
+    def get_host(self):
+        return get_source_host(self.uri)
+
     def is_dumb_transport(self):
         """ Http depth cloning = no go """
         if self.uri.startswith("http:") or self.uri.startswith("https:"):
@@ -97,16 +168,13 @@ class GitSource(YpkgSource):
         source_dir = context.get_sources_directory()
 
         # Ensure source dir exists
-        if not os.path.exists(source_dir):
-            try:
-                os.makedirs(source_dir, mode=00755)
-            except Exception as e:
-                console_ui.emit_error("Source", "Cannot create sources "
-                                      "directory: {}".format(e))
-                return False
+        if not ensure_sources_directory(source_dir):
+            return False
 
         cmd = "git -C \"{}\" clone \"{}\" {}".format(
             source_dir, self.uri, self.get_target_name())
+        if self.quiet:
+            cmd += " --quiet"
 
         console_ui.emit_info("Git", "Fetching: {}".format(self.uri))
         try:
@@ -210,52 +278,130 @@ class TarSource(YpkgSource):
     def __str__(self):
         return "%s (%s)" % (self.uri, self.hash)
 
+    def get_host(self):
+        return get_source_host(self.uri)
+
+    def get_fetched_size(self, context):
+        return os.path.getsize(self._get_full_path(context))
+
     def _get_full_path(self, context):
         bpath = os.path.join(context.get_sources_directory(),
                              self.filename)
         return bpath
 
+    def download(self, ppath):
+        """ Download into the partial file ppath, resuming from wherever a
+            previous attempt left off """
+        cmd = "curl -o \"{}\" --url \"{}\" --location --fail " \
+              "--continue-at -".format(ppath, self.uri)
+        if self.quiet:
+            cmd += " --silent --show-error"
+        r = subprocess.call(cmd, shell=True)
+        if r in CURL_RANGE_ERRORS and os.path.exists(ppath):
+            # No range support, so the next attempt starts over
+            os.unlink(ppath)
+        return r == 0
+
     def fetch(self, context):
         source_dir = context.get_sources_directory()
 
         # Ensure source dir exists
-        if not os.path.exists(source_dir):
+        if not ensure_sources_directory(source_dir):
+            return False
+
+        console_ui.emit_info("Source", "Fetching: {}".format(self.uri))
+        fpath = self._get_full_path(context)
+        ppath = fpath + PARTIAL_SUFFIX
+
+        attempt = 0
+        while True:
+            resumed = os.path.exists(ppath)
             try:
-                os.makedirs(source_dir, mode=00755)
+                if self.download(ppath):
+                    hash = hash_file(ppath)
+                    if hash == self.hash:
+                        break
+                    # A bad resume may be to blame, so only that is retried
+                    os.unlink(ppath)
+                    if not resumed:
+                        console_ui.emit_error("Source", "Incorrect hash for "
+                                              "{}".format(self.filename))
+                        print("Found hash    : {}".format(hash))
+                        print("Expected hash : {}".format(self.hash))
+                        return False
             except Exception as e:
-                console_ui.emit_error("Source", "Cannot create sources "
-                                      "directory: {}".format(e))
+                console_ui.emit_error("Source", "Failed to fetch {}".format(
+                                      self.uri))
+                print("Error follows: {}".format(e))
                 return False
 
-        console_ui.emit_info("Source", "Fetching: {}".format(self.uri))
-        fpath = self._get_full_path(context)
-        cmd = "curl -o \"{}\" --url \"{}\" --location".format(
-               fpath, self.uri)
+            if attempt >= self.retries:
+                console_ui.emit_error("Source", "Failed to fetch {}".format(
+                                      self.uri))
+                return False
+            delay = self.retry_delay * (2 ** attempt)
+            attempt += 1
+            console_ui.emit_warning("Source", "Retrying {} in {}s ({}/{})".
+                                    format(self.filename, delay, attempt,
+                                           self.retries))
+            time.sleep(delay)
+
+        # Only now is the source visible to cached() and later builds
         try:
-            r = subprocess.check_call(cmd, shell=True)
+            os.rename(ppath, fpath)
         except Exception as e:
-            console_ui.emit_error("Source", "Failed to fetch {}".format(
-                                  self.uri))
-            print("Error follows: {}".format(e))
+            console_ui.emit_error("Source", "Cannot store {}: {}".format(
+                                  self.filename, e))
             return False
-
+        self.set_verified_hash(context, hash)
         return True
 
+    def _get_verified_path(self, context):
+        return self._get_full_path(context) + VERIFIED_SUFFIX
+
+    def get_verified_hash(self, context):
+        """ Return the hash recorded when the file was last verified, as long
+            as the file has not changed since, otherwise None """
+        vpath = self._get_verified_path(context)
+        if not os.path.exists(vpath):
+            return None
+        try:
+            with open(vpath, "r") as inp:
+                data = json.load(inp)
+            identity = get_file_identity(self._get_full_path(context))
+        except Exception:
+            return None
+        if data.get("identity") != identity:
+            return None
+        return data.get("sha256")
+
+    def set_verified_hash(self, context, hash):
+        """ Record the hash of the file as verified """
+        bpath = self._get_full_path(context)
+        vpath = self._get_verified_path(context)
+        data = {"identity": get_file_identity(bpath), "sha256": hash}
+        try:
+            atomic_write_json(vpath, data)
+        except Exception as e:
+            console_ui.emit_warning("Source", "Cannot record verified hash: "
+                                    "{}".format(e))
+
     def verify(self, context):
         bpath = self._get_full_path(context)
 
-        hash = None
+        hash = self.get_verified_hash(context)
+        verified = hash is not None
+        if not verified:
+            hash = hash_file(bpath)
 
-        with open(bpath, "r") as inp:
-            h = hashlib.sha256()
-            h.update(inp.read())
-            hash = h.hexdigest()
         if hash != self.hash:
             console_ui.emit_error("Source", "Incorrect hash for {}".
                                   format(self.filename))
             print("Found hash    : {}".format(hash))
             print("Expected hash : {}".format(self.hash))
             return False
+        if not verified:
+            self.set_verified_hash(context, hash)
         return True
 
         target = os.path.join(BallDir, os.path.basename(x))
@@ -338,6 +484,10 @@ class SourceManager:
 
     sources = None
 
+    # Shared between fetch_sources workers
+    lock = None
+    fetched_bytes = 0
+
     def __init__(self):
         self.sources = list()
 
@@ -373,6 +523,80 @@ class SourceManager:
 
         return True
 
+    def obtain_source(self, context, source, host_limits):
+        """ Fetch the source if needed, then verify it. This is a pool entry
+            point, returning the stage that failed or None. """
+        if not source.cached(context):
+            with host_limits[source.get_host()]:
+                if not source.fetch(context):
+                    return "fetch"
+            with self.lock:
+                self.fetched_bytes += source.get_fetched_size(context)
+        if not source.verify(context):
+            return "verify"
+        return None
+
+    def fetch_sources(self, context, jobs=DEFAULT_FETCH_JOBS,
+                      host_jobs=DEFAULT_HOST_JOBS):
+        """ Fetch and verify all sources, up to jobs at once and no more than
+            host_jobs from any one host. Each source is verified as soon as
+            it has been fetched, and failed downloads are retried. """
+        self.lock = threading.Lock()
+        self.fetched_bytes = 0
+
+        # Create it up front, rather than leave each worker to
+        if not ensure_sources_directory(context.get_sources_directory()):
+            return False
+
+        host_limits = dict()
+        by_host = dict()
+        for source in self.sources:
+            host = source.get_host()
+            if host not in host_limits:
+                host_limits[host] = threading.Semaphore(host_jobs)
+                by_host[host] = list()
+            by_host[host].append(source)
+
+        # Interleave hosts so that waiting on a busy one blocks few workers
+        order = list()
+        queues = [by_host[x] for x in sorted(by_host, key=str)]
+        while any(queues):
+            for queue in queues:
+                if queue:
+                    order.append(queue.pop(0))
+
+        jobs = max(1, min(jobs, len(order)))
+        for source in order:
+            source.quiet = jobs > 1
+
+        start = time.time()
+        if jobs == 1:
+            results = [self.obtain_source(context, x, host_limits)
+                       for x in order]
+        else:
+            pool = ThreadPool(jobs)
+            try:
+                results = pool.map(lambda x: self.obtain_source(context, x,
+                                                                host_limits),
+                                   order, 1)
+            finally:
+                pool.close()
+                pool.join()
+        duration = time.time() - start
+
+        if "fetch" in results:
+            console_ui.emit_error("Source", "Cannot continue without sources")
+            return False
+        if "verify" in results:
+            console_ui.emit_error("Source", "Cannot verify sources")
+            return False
+
+        if self.fetched_bytes > 0:
+            mb = self.fetched_bytes / (1024.0 * 1024.0)
+            console_ui.emit_info("Source", "Fetched {:.1f} MB at {:.1f} MB/s".
+                                 format(mb, mb / max(duration, 0.001)))
+        return True
+
     def _get_working_dir(self, context):
         """ Need to make this.. better. It's very tar-type now"""
         build_dir = context.get_build_dir()
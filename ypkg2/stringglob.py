@@ -13,6 +13,7 @@
 
 import fnmatch
 import os
+import re
 
 
 class StringPathGlob:
@@ -81,3 +82,89 @@ class StringPathGlob:
 
     def get_priority(self):
         return self.priority
+
+
+class StringPathGlobNode:
+    """ Single path component level within a StringPathGlobSet """
+
+    def __init__(self):
+        self.literals = dict()
+        self.globs = dict()
+        # (priority, order, glob) for patterns ending at this component
+        self.matches = list()
+        # As above, but requiring at least one further path component
+        self.prefixes = list()
+
+    def get_child(self, elem):
+        if not StringPathGlob.is_a_pattern(elem):
+            if elem not in self.literals:
+                self.literals[elem] = StringPathGlobNode()
+            return self.literals[elem]
+        if elem not in self.globs:
+            regex = re.compile(fnmatch.translate(elem))
+            self.globs[elem] = (regex, StringPathGlobNode())
+        return self.globs[elem][1]
+
+
+class StringPathGlobSet:
+    """ Compiles a collection of StringPathGlobs into a trie of path
+        components, so that the highest priority pattern matching a path
+        is found in one walk rather than by evaluating every pattern.
+        Equal priorities are resolved by the iteration order of the given
+        collection, as a stable sort of the matches would do. """
+
+    def __init__(self, globs):
+        self.root = StringPathGlobNode()
+        for order, glob in enumerate(globs):
+            self.add(glob, order)
+
+    def add(self, glob, order):
+        pattern = glob.pattern
+        prefix = False
+        if glob.prefixMatch:
+            # Mirror StringPathGlob.match, anything else can never match
+            if not pattern.endswith(os.sep) or \
+                    StringPathGlob.is_a_pattern(pattern):
+                return
+            pattern = pattern[:-len(os.sep)]
+            prefix = True
+
+        node = self.root
+        for elem in pattern.split(os.sep):
+            node = node.get_child(elem)
+
+        entry = (glob.priority, -order, glob)
+        if prefix:
+            node.prefixes.append(entry)
+        else:
+            node.matches.append(entry)
+
+    def match(self, path):
+        """ Return the winning pattern for path, or None """
+        best = None
+        active = [self.root]
+        for elem in path.split(os.sep):
+            following = list()
+            for node in active:
+                for entry in node.matches:
+                    if best is None or entry[0:2] > best[0:2]:
+                        best = entry
+                # There is a further component, so prefixes apply here
+                for entry in node.prefixes:
+                    if best is None or entry[0:2] > best[0:2]:
+                        best = entry
+                if elem in node.literals:
+                    following.append(node.literals[elem])
+                for regex, child in node.globs.values():
+                    if regex.match(elem):
+                        following.append(child)
+            active = following
+            if len(active) == 0:
+                break
+        for node in active:
+            for entry in node.matches:
+                if best is None or entry[0:2] > best[0:2]:
+                    best = entry
+        if best is None:
+            return None
+        return best[2]
@@ -0,0 +1,177 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+# Streaming XML output for documents with very long lists of entries.
+#
+# Rather than reimplement the serialiser used by pisi, and risk differing
+# from it, a small sample document is serialised by pisi with placeholder
+# values. The lines around the placeholders become templates that are
+# then filled in for every real entry, so the result is byte identical to
+# what pisi would have written for the full document.
+
+SENTINEL = "@@ypkg:{}@@"
+
+# Characters that a serialiser may escape, along with a non-ASCII one
+PROBE_UNITS = ["&", "<", ">", "\"", "'", "\xc3\xa9"]
+PROBE_END = "@@ypkg@@"
+
+
+class XmlTemplateError(Exception):
+    pass
+
+
+def get_sentinel(field):
+    """ Placeholder value for a field """
+    return SENTINEL.format(field)
+
+
+def get_probe(field):
+    """ Placeholder value for a field that reveals how it is escaped """
+    return get_sentinel(field) + "".join(PROBE_UNITS) + PROBE_END
+
+
+def read_escapes(text, field):
+    """ Learn how the probe for field was escaped within text, returning a
+        list of (character, replacement) with '&' first """
+    sentinel = get_sentinel(field)
+    start = text.find(sentinel)
+    while start >= 0:
+        # Skip plain sentinels, the probe is terminated on the same line
+        start += len(sentinel)
+        eol = text.find("\n", start)
+        end = text.find(PROBE_END, start, eol if eol >= 0 else len(text))
+        if end >= 0:
+            break
+        start = text.find(sentinel, start)
+    if start < 0:
+        raise XmlTemplateError("No probe found for {}".format(field))
+    escaped = text[start:end]
+
+    escapes = list()
+    pos = 0
+    for unit in PROBE_UNITS:
+        # Raw '&' is never valid XML, so it always starts a reference
+        if escaped.startswith("&", pos) and ";" in escaped[pos:]:
+            replacement = escaped[pos:escaped.index(";", pos) + 1]
+        elif escaped.startswith(unit, pos):
+            replacement = unit
+        else:
+            raise XmlTemplateError("Cannot follow escaping of {}".format(
+                                   field))
+        pos += len(replacement)
+        if unit == PROBE_UNITS[-1]:
+            if replacement != unit:
+                raise XmlTemplateError("Non-ASCII text is escaped")
+            continue
+        if replacement != unit:
+            escapes.append((unit, replacement))
+    if pos != len(escaped):
+        raise XmlTemplateError("Unexpected escaping of {}".format(field))
+    return escapes
+
+
+class LineTemplate:
+    """ A line of serialised XML holding one or more placeholder values.
+        Rendering skips the line entirely if any of its values is None,
+        mirroring how optional elements are omitted. """
+
+    def __init__(self, line, sentinels, escapes):
+        self.literals = list()
+        self.fields = list()
+        self.escapes = escapes
+
+        found = list()
+        for field in sentinels:
+            count = line.count(sentinels[field])
+            if count > 1:
+                raise XmlTemplateError("Ambiguous placeholder in {}".
+                                       format(line))
+            if count == 1:
+                found.append((line.index(sentinels[field]), field))
+
+        pos = 0
+        for index, field in sorted(found):
+            self.literals.append(line[pos:index])
+            self.fields.append(field)
+            pos = index + len(sentinels[field])
+        self.literals.append(line[pos:])
+
+        if self.fields and line.count("<") != 2:
+            raise XmlTemplateError("Expected one element per line: {}".
+                                   format(line))
+
+    def escape(self, field, value):
+        if not isinstance(value, basestring):
+            return str(value)
+        for char, replacement in self.escapes.get(field, []):
+            if char in value:
+                value = value.replace(char, replacement)
+        return value
+
+    def render(self, values):
+        ret = self.literals[0]
+        for i, field in enumerate(self.fields):
+            value = values[field]
+            if value is None:
+                return ""
+            ret += self.escape(field, value) + self.literals[i + 1]
+        return ret
+
+
+class ListTemplate:
+    """ Template for a document holding a single list of entries, split into
+        the header, per-entry lines and footer. It is built from a sample
+        holding two entries of the given element: the first with sentinel
+        values and the second with probes. """
+
+    def __init__(self, text, element, sentinels, key):
+        lines = text.splitlines(True)
+        matches = [i for i, x in enumerate(lines) if sentinels[key] in x]
+        if len(matches) != 2:
+            raise XmlTemplateError("Sample entries not found")
+        first = self._find_entry(lines, element, matches[0])
+        second = self._find_entry(lines, element, matches[1])
+        if second[0] != first[1]:
+            raise XmlTemplateError("Sample entries are not adjacent")
+
+        probed = "".join(lines[second[0]:second[1]])
+        escapes = dict()
+        for field in sentinels:
+            if sentinels[field] == get_sentinel(field):
+                escapes[field] = read_escapes(probed, field)
+
+        self.header = "".join(lines[0:first[0]])
+        self.footer = "".join(lines[second[1]:])
+        self.lines = [LineTemplate(x, sentinels, escapes)
+                      for x in lines[first[0]:first[1]]]
+
+    def _find_entry(self, lines, element, index):
+        """ Return the (start, end) lines of the entry around line index """
+        start = index
+        while start >= 0 and lines[start].strip() != "<{}>".format(element):
+            start -= 1
+        end = index
+        while end < len(lines) and \
+                lines[end].strip() != "</{}>".format(element):
+            end += 1
+        if start < 0 or end >= len(lines):
+            raise XmlTemplateError("Cannot find bounds of {}".format(element))
+        return start, end + 1
+
+    def write(self, out, entries):
+        """ Write the document for every dict of values in entries """
+        out.write(self.header)
+        for values in entries:
+            for line in self.lines:
+                out.write(line.render(values))
+        out.write(self.footer)
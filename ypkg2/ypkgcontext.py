@@ -189,6 +189,9 @@ class YpkgContext:
 
     can_dbginfo = False
 
+    # InstallManifest of the install tree, once it has been populated
+    manifest = None
+
     def __init__(self, spec, emul32=False, avx2=False):
         self.spec = spec
         self.emul32 = emul32
@@ -226,6 +229,10 @@ class YpkgContext:
             return "/var/ypkg-root"
         return "{}/YPKG".format(os.path.expanduser("~"))
 
+    def get_cache_dir(self):
+        """ Get the directory used for caches persisted between builds """
+        return os.path.join(self.get_build_prefix(), "cache")
+
     def get_install_dir(self):
         """ Get the install directory for the given package """
         return os.path.abspath("{}/root/{}/install".format(